@@ -0,0 +1,302 @@
+# Times every prefix optimizer on small random-weight GPTNeoX forward/reverse models that are built
+# locally, so it runs on CPU without any downloads. Each case runs in a fresh process. Results go to a
+# JSON file that can later be passed as --baseline to flag regressions in wall time, forward-pass count
+# and the peak memory of the optimize call over the resident set size before it.
+import argparse
+import concurrent.futures
+import ctypes
+import gc
+import itertools
+import json
+import multiprocessing
+import os
+import platform
+import random
+import resource
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import torch
+from tokenizers import Tokenizer, decoders, models, pre_tokenizers, trainers
+from transformers import GPTNeoXConfig, GPTNeoXForCausalLM, PreTrainedTokenizerFast
+
+from src import *
+from src.instrumentation import read_peak_rss_kb, read_rss_kb, reset_peak_rss
+
+
+OPTIMIZERS = [
+    "gcg",
+    "reverse_model_sampler",
+    "reverse_model_beam_search",
+    "reversal_lm_prior",
+    "reversal_empirical_prior",
+]
+
+WORDS = [
+    "the", "a", "of", "and", "to", "in", "is", "was", "it", "for", "on", "with", "as", "at", "by",
+    "model", "token", "reverse", "prefix", "suffix", "language", "sample", "beam", "search", "loss",
+    "gradient", "prior", "posterior", "data", "text", "word", "string", "probability", "likely",
+]
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(description='Benchmark prefix optimizers on tiny local models.')
+
+    parser.add_argument("--optimizers", type=str, nargs="+", default=OPTIMIZERS, choices=OPTIMIZERS)
+    parser.add_argument("--prefix_lengths", type=int, nargs="+", default=[4, 10])
+    parser.add_argument("--suffix_lengths", type=int, nargs="+", default=[8, 40])
+    parser.add_argument("--vocab_batch_sizes", type=int, nargs="+", default=[128, 512])
+    parser.add_argument("--beam_widths", type=int, nargs="+", default=[5, 20])
+    # Tiny model
+    parser.add_argument("--vocab_size", type=int, default=1024)
+    parser.add_argument("--hidden_size", type=int, default=64)
+    parser.add_argument("--num_layers", type=int, default=2)
+    parser.add_argument("--num_heads", type=int, default=4)
+    # GCG
+    parser.add_argument("--gcg_epochs", type=int, default=8)
+    parser.add_argument("--gcg_proposals", type=int, default=64)
+    parser.add_argument("--gcg_top_indices", type=int, default=32)
+    parser.add_argument("--reversal_num_tokens", type=int, default=256)
+    # Runs
+    parser.add_argument("--repeats", type=int, default=5, help="wall time is the fastest repeat")
+    parser.add_argument("--num_threads", type=int, default=1)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--no_isolate", action="store_true", help="run all cases in this process")
+    parser.add_argument("--output", type=str, default="benchmark_results.json")
+    parser.add_argument("--baseline", type=str, default=None)
+    parser.add_argument("--time_tolerance", type=float, default=0.25)
+    parser.add_argument("--memory_tolerance", type=float, default=0.10)
+    parser.add_argument("--memory_slack_mb", type=float, default=2.0, help="absolute slack on top of --memory_tolerance, for allocator noise")
+
+    return parser.parse_args()
+
+
+def build_tokenizer(vocab_size, seed=0):
+    # Byte-level BPE trained on a synthetic corpus, so every string can be encoded
+    rng = random.Random(seed)
+    corpus = [" ".join(rng.choice(WORDS) for _ in range(32)) for _ in range(2000)]
+    tokenizer = Tokenizer(models.BPE())
+    tokenizer.pre_tokenizer = pre_tokenizers.ByteLevel(add_prefix_space=False)
+    tokenizer.decoder = decoders.ByteLevel()
+    trainer = trainers.BpeTrainer(
+        vocab_size=vocab_size,
+        special_tokens=["<|endoftext|>"],
+        initial_alphabet=pre_tokenizers.ByteLevel.alphabet()
+    )
+    tokenizer.train_from_iterator(corpus, trainer)
+    return PreTrainedTokenizerFast(
+        tokenizer_object=tokenizer,
+        bos_token="<|endoftext|>",
+        eos_token="<|endoftext|>",
+        pad_token="<|endoftext|>",
+    )
+
+
+def build_model(vocab_size, hidden_size, num_layers, num_heads, seed):
+    torch.manual_seed(seed)
+    config = GPTNeoXConfig(
+        vocab_size=vocab_size,
+        hidden_size=hidden_size,
+        num_hidden_layers=num_layers,
+        num_attention_heads=num_heads,
+        intermediate_size=4 * hidden_size,
+        max_position_embeddings=512,
+    )
+    return GPTNeoXForCausalLM(config)
+
+
+def build_cases(args):
+    cases = []
+    for opt_name in args.optimizers:
+        if opt_name in ["reverse_model_sampler", "reverse_model_beam_search"]:
+            extra = [{"beam_width": b} for b in args.beam_widths]
+        elif opt_name in ["reversal_lm_prior", "reversal_empirical_prior"]:
+            extra = [{"vocab_batch_size": b} for b in args.vocab_batch_sizes]
+        else:
+            extra = [{}]
+        for prefix_length, suffix_length, params in itertools.product(args.prefix_lengths, args.suffix_lengths, extra):
+            case = {"optimizer": opt_name, "prefix_length": prefix_length, "suffix_length": suffix_length}
+            case.update(params)
+            case["case"] = "-".join(f"{k}={v}" for k, v in case.items())
+            cases.append(case)
+    return cases
+
+
+def build_optimizer(case, args, model, reverse_model, tokenizer):
+    opt_name = case["optimizer"]
+    if opt_name == "gcg":
+        return GreedyCoordinateGradient(
+            model,
+            tokenizer,
+            n_proposals=args.gcg_proposals,
+            n_epochs=args.gcg_epochs,
+            n_top_indices=args.gcg_top_indices
+        )
+    if opt_name == "reverse_model_sampler":
+        return ReverseModelSampler(model, reverse_model, tokenizer, num_beams=case["beam_width"])
+    if opt_name == "reverse_model_beam_search":
+        return ReverseModelSamplerBeamSearch(model, reverse_model, tokenizer, num_beams=case["beam_width"])
+    if opt_name == "reversal_lm_prior":
+        return ReversalLMPrior(
+            model,
+            reverse_model,
+            tokenizer,
+            batch_size=case["vocab_batch_size"],
+            num_top_tokens=args.reversal_num_tokens
+        )
+    dist = torch.rand(model.config.vocab_size)
+    return ReversalEmpiricalPrior(model, dist / dist.sum(), tokenizer, batch_size=case["vocab_batch_size"])
+
+
+def random_text(num_tokens, tokenizer):
+    return tokenizer.decode(torch.randint(1, tokenizer.vocab_size, (num_tokens,)))
+
+
+def count_forward_passes(model, counter, name):
+    # Scorers call the base model directly to skip the full logits, so count passes through it
+    def hook(module, inputs):
+        counter[name] += 1
+    return model.base_model.register_forward_pre_hook(hook)
+
+
+def pin_mmap_threshold(threshold=65536):
+    # glibc raises its mmap threshold as large blocks are freed, which moves tensors between mmap and the
+    # heap from one call to the next. A fixed threshold keeps the peak memory reproducible across runs.
+    try:
+        ctypes.CDLL("libc.so.6").mallopt(-3, threshold)  # M_MMAP_THRESHOLD
+    except (OSError, AttributeError):
+        pass
+
+
+def release_memory():
+    # Return the memory freed by earlier calls to the OS, so that every call faults in its own working set
+    gc.collect()
+    try:
+        ctypes.CDLL("libc.so.6").malloc_trim(0)
+    except (OSError, AttributeError):
+        pass
+
+
+def optimize_peak_mb(optimizer, prefix, suffix):
+    # Peak resident set size of the optimize call over the one before it, so the models, the tokenizer
+    # and torch itself are not counted. Without /proc, the growth of the process peak is a lower bound.
+    if reset_peak_rss():
+        rss_kb = read_rss_kb()
+        optimizer.optimize(prefix, suffix)
+        return (read_peak_rss_kb() - rss_kb) / 1024
+    # ru_maxrss is in kilobytes on Linux and bytes on macOS
+    unit = 1024 ** 2 if sys.platform == "darwin" else 1024
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    optimizer.optimize(prefix, suffix)
+    return (resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - maxrss) / unit
+
+
+def run_case(case, args):
+    pin_mmap_threshold()
+    runtime = set_runtime(InferenceRuntime(device="cpu", num_threads=args.num_threads))
+    tokenizer = build_tokenizer(args.vocab_size, seed=args.seed)
+    # Pad the embedding like the Pythia models do (50277 tokens, 50304 logits)
+    model_vocab = 64 * ((len(tokenizer) + 63) // 64)
+    model = runtime.prepare(build_model(model_vocab, args.hidden_size, args.num_layers, args.num_heads, args.seed))
+    reverse_model = runtime.prepare(build_model(model_vocab, args.hidden_size, args.num_layers, args.num_heads, args.seed + 1))
+    optimizer = build_optimizer(case, args, model, reverse_model, tokenizer)
+
+    counter = {"model": 0, "reverse_model": 0}
+    hooks = [
+        count_forward_passes(model, counter, "model"),
+        count_forward_passes(reverse_model, counter, "reverse_model"),
+    ]
+    # Untimed warm-up, so one-off allocations and lazy initialisation are not counted
+    torch.manual_seed(args.seed)
+    optimizer.optimize(random_text(case["prefix_length"], tokenizer), random_text(case["suffix_length"], tokenizer))
+    wall_times = []
+    peaks = []
+    for repeat in range(args.repeats):
+        torch.manual_seed(args.seed + repeat)
+        prefix = random_text(case["prefix_length"], tokenizer)
+        suffix = random_text(case["suffix_length"], tokenizer)
+        for name in counter:
+            counter[name] = 0
+        release_memory()
+        t1 = time.perf_counter()
+        peaks.append(optimize_peak_mb(optimizer, prefix, suffix))
+        wall_times.append(time.perf_counter() - t1)
+    for hook in hooks:
+        hook.remove()
+
+    result = dict(case)
+    result.update({
+        "wall_time": min(wall_times),
+        "wall_times": wall_times,
+        "forward_passes": dict(counter),
+        "peak_memory_mb": max(peaks),
+        "peak_memory_mbs": peaks,
+    })
+    return result
+
+
+def run_cases(cases, args):
+    if args.no_isolate:
+        for case in cases:
+            yield run_case(case, args)
+        return
+    # A fresh process per case, so that no case runs on memory a previous one left allocated
+    context = multiprocessing.get_context("spawn")
+    for case in cases:
+        with concurrent.futures.ProcessPoolExecutor(max_workers=1, mp_context=context) as pool:
+            yield pool.submit(run_case, case, args).result()
+
+
+def compare_to_baseline(results, baseline, args):
+    regressions = []
+    baseline_results = {r["case"]: r for r in baseline["results"]}
+    for result in results:
+        reference = baseline_results.get(result["case"])
+        if reference is None:
+            continue
+        if result["wall_time"] > reference["wall_time"] * (1 + args.time_tolerance):
+            regressions.append((result["case"], "wall_time", reference["wall_time"], result["wall_time"]))
+        for name, count in result["forward_passes"].items():
+            if count > reference["forward_passes"].get(name, 0):
+                regressions.append((result["case"], f"forward_passes.{name}", reference["forward_passes"].get(name, 0), count))
+        # Baselines from before peak_memory_mb recorded the peak RSS of the whole process, they are not comparable
+        if "peak_memory_mb" in reference and result["peak_memory_mb"] > reference["peak_memory_mb"] * (1 + args.memory_tolerance) + args.memory_slack_mb:
+            regressions.append((result["case"], "peak_memory_mb", reference["peak_memory_mb"], result["peak_memory_mb"]))
+    return regressions
+
+
+def main():
+    args = parse_arguments()
+    cases = build_cases(args)
+
+    results = []
+    for result in run_cases(cases, args):
+        print(f'{result["case"]}: {result["wall_time"]:.3f}s, forward passes {result["forward_passes"]}, peak memory {result["peak_memory_mb"]:.1f}MB')
+        results.append(result)
+
+    output = {
+        "meta": {
+            "python": platform.python_version(),
+            "torch": torch.__version__,
+            "platform": platform.platform(),
+            "parameters": vars(args),
+        },
+        "results": results,
+    }
+    with open(args.output, 'w') as f:
+        json.dump(output, f, indent=2)
+
+    if args.baseline is not None:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        regressions = compare_to_baseline(results, baseline, args)
+        for case, metric, before, after in regressions:
+            print(f'REGRESSION {case} {metric}: {before} -> {after}')
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,31 @@
+import argparse
+
+from transformers import AutoTokenizer, GPTNeoXForCausalLM
+from src.runtime import InferenceRuntime, set_runtime
+from src.transition_index import build_transition_index
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(description='Build the forward transition index of a model.')
+    parser.add_argument('--model_size', type=str, default="160m")
+    parser.add_argument("--output", type=str, default=None, help="defaults to data/transition_index/pythia-<model_size>-deduped-k<top_k>")
+    parser.add_argument("--top_k", type=int, default=256, help="next tokens kept per token")
+    parser.add_argument("--batch_size", type=int, default=1024, help="tokens per forward pass")
+    parser.add_argument("--device", type=str, default=None)
+    parser.add_argument("--dtype", type=str, default=None, choices=["fp32", "bf16", "fp16"])
+    return parser.parse_args()
+
+
+def main():
+    args = parse_arguments()
+    name = f"EleutherAI/pythia-{args.model_size}-deduped"
+    output = args.output or f"data/transition_index/pythia-{args.model_size}-deduped-k{args.top_k}"
+    runtime = set_runtime(InferenceRuntime(device=args.device, dtype=args.dtype))
+    model = runtime.prepare(GPTNeoXForCausalLM.from_pretrained(name))
+    tokenizer = AutoTokenizer.from_pretrained("afterless/reverse-pythia-160m")
+    index = build_transition_index(model, output, top_k=args.top_k, batch_size=args.batch_size, tokenizer=tokenizer, model_name=name)
+    print(f"{index.vocab_size} tokens, top {index.top_k} transitions in {output}")
+
+
+if __name__ == "__main__":
+    main()
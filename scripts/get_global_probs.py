@@ -1,25 +1,68 @@
+import argparse
+import multiprocessing
+import os
+
 import torch
 from transformers import AutoTokenizer
-from utils import get_token_probabilities_pandas
-import pandas as pd
-from joblib import Parallel, delayed
+from src.token_counts import count_shard, counts_to_probs, merge_counts
+
 
-tokenizer = AutoTokenizer.from_pretrained("afterless/reverse-pythia-160m")
+def parse_arguments():
+    parser = argparse.ArgumentParser(description='Count Pile tokens into an empirical prior.')
+    parser.add_argument("--data_dir", type=str, default="/vast/work/public/ml-datasets/pile/train")
+    parser.add_argument("--shards", type=int, nargs="+", default=list(range(10)))
+    parser.add_argument("--output_dir", type=str, default="/home/jp6263/reverse-dynamics-nlp")
+    parser.add_argument("--tokenizer", type=str, default="afterless/reverse-pythia-160m")
+    parser.add_argument("--vocab_size", type=int, default=50304, help="model output dimension, tokenizer.vocab_size is smaller")
+    parser.add_argument("--positions", type=int, default=None, help="also count the first tokens of every document per position")
+    parser.add_argument("--chunk_size", type=int, default=100000, help="documents per chunk, partial counts are saved after every chunk")
+    parser.add_argument("--batch_size", type=int, default=1000, help="documents per tokenizer call")
+    parser.add_argument("--max_chunks", type=int, default=11, help="chunks per shard, all of them when 0")
+    parser.add_argument("--num_workers", type=int, default=os.cpu_count())
+    return parser.parse_args()
 
-def process_file(i, end=10):
-    prev_counts = None
+
+def process_file(task):
+    args, i = task
     num = str(i).zfill(2)
-    print(num)
-    file_path = f'/vast/work/public/ml-datasets/pile/train/{num}.jsonl'
-    json_reader = pd.read_json(file_path, lines=True, chunksize=100000)  # Adjust chunksize as needed
-    
-    for c,chunk in enumerate(json_reader):
-        print(c)
-        prev_counts = get_token_probabilities_pandas(tokenizer, dataset=chunk.itertuples(), prev_counts=prev_counts)
-        if c == end:
-            break
-    
-    with open(f'/home/jp6263/reverse-dynamics-nlp/abs_counts_{num}.pt', 'wb') as f:
-        torch.save(prev_counts, f)
-
-Parallel(n_jobs=-1)(delayed(process_file)(i) for i in range(0,10))
+    tokenizer = AutoTokenizer.from_pretrained(args.tokenizer)
+    # Partial counts, a restarted job continues after the last completed chunk
+    output_path = os.path.join(args.output_dir, f'abs_counts_{num}.partial.pt')
+    state = count_shard(
+        tokenizer,
+        os.path.join(args.data_dir, f'{num}.jsonl'),
+        output_path,
+        vocab_size=args.vocab_size,
+        positions=args.positions,
+        chunk_size=args.chunk_size,
+        batch_size=args.batch_size,
+        max_chunks=args.max_chunks or None,
+    )
+    torch.save(state["unigram"], os.path.join(args.output_dir, f'abs_counts_{num}.pt'))
+    print(num, state["lines"], "documents")
+    return output_path
+
+
+def main():
+    args = parse_arguments()
+    os.makedirs(args.output_dir, exist_ok=True)
+    tasks = [(args, i) for i in args.shards]
+    num_workers = min(args.num_workers, len(tasks))
+    if num_workers == 1:
+        paths = [process_file(task) for task in tasks]
+    else:
+        # Each worker tokenizes one shard, the tokenizer's own threads are left to the workers
+        os.environ.setdefault("TOKENIZERS_PARALLELISM", "false")
+        with multiprocessing.get_context("spawn").Pool(num_workers) as pool:
+            paths = pool.map(process_file, tasks)
+
+    merged = merge_counts(paths)
+    torch.save(merged["unigram"], os.path.join(args.output_dir, 'abs_counts.pt'))
+    torch.save(counts_to_probs(merged["unigram"]), os.path.join(args.output_dir, 'pile_empirical.pt'))
+    if args.positions:
+        torch.save(merged["positional"], os.path.join(args.output_dir, f'pos_counts_{args.positions}.pt'))
+        torch.save(counts_to_probs(merged["positional"]), os.path.join(args.output_dir, f'probs_{args.positions}.pt'))
+
+
+if __name__ == "__main__":
+    main()
@@ -7,6 +7,8 @@ import torch
 from datasets import load_dataset
 from transformers import AutoTokenizer, GPTNeoXForCausalLM
 from src import *
+import json
+import multiprocessing
 import pickle
 
 import time
@@ -26,35 +28,58 @@ def parse_arguments():
     parser.add_argument("--num_suffix_tokens", type=int, default=40)
     parser.add_argument("--reversal_num_tokens", type=int, default=10000)
     parser.add_argument("--vocab_batch_size", type=int, default=1000)
+    parser.add_argument("--gcg_restarts", type=int, default=1, help="GCG restarts run in lockstep, the best one is kept")
+    # GCG early stopping, all off by default
+    parser.add_argument("--gcg_patience", type=int, default=None, help="stop after this many epochs without improving the best loss by more than --gcg_min_delta")
+    parser.add_argument("--gcg_min_delta", type=float, default=0.0)
+    parser.add_argument("--gcg_target_loss", type=float, default=None, help="stop once the suffix loss is this low")
+    parser.add_argument("--gcg_time_budget", type=float, default=None, help="seconds per GCG call")
+    parser.add_argument("--gcg_stop_on_greedy_match", action="store_true", help="stop once greedy decoding from the prefix reproduces the suffix")
+    parser.add_argument("--screening_model_size", type=str, default=None, help="e.g. 70m, screens candidates and beams before the model scores the top fraction")
+    parser.add_argument("--screening_fraction", type=float, default=0.1)
     parser.add_argument("--filename_prefix", type=str, default="")
+    # Runtime
+    parser.add_argument("--device", type=str, default=None)
+    parser.add_argument("--dtype", type=str, default=None, choices=["fp32", "bf16", "fp16"])
+    parser.add_argument("--compile", action="store_true")
+    parser.add_argument("--num_threads", type=int, default=None)
+    parser.add_argument("--memory_budget_gb", type=float, default=None, help="memory per worker batch sizes plan for, defaults to a share of the available memory")
+    parser.add_argument("--instrument", action="store_true", help="record forward/backward passes and phase timings per optimizer call")
+    # Harness
+    parser.add_argument("--num_workers", type=int, default=1, help="worker processes, each loads its own copy of the models")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--results_dir", type=str, default="data/results", help="parquet store, one row per (pair, optimizer)")
+    parser.add_argument("--pickle", action="store_true", help="also export the run as the old suffix-keyed pickle")
+    parser.add_argument("--flush_every", type=int, default=1, help="results buffered per parquet part, every result is written as it finishes by default")
+    parser.add_argument("--checkpoint_dir", type=str, default=None, help="optimizer checkpoints, so preempted pairs resume mid-optimization")
     
     
     return parser.parse_args()
 
 
-def get_statistics(prefix, suffix, optimizer, model, tokenizer):
-    # Get prediction according to optimizer
+# Models and optimizers of this process, loaded once by init_worker
+WORKER = {}
+
+
+def get_statistics(prefix_ids, suffix_ids, optimizer, model, tokenizer, name=None, instrument=False):
+    # Get prediction according to optimizer, which already scored the prefix it returns
     t1 = time.time()
-    optimized_string = optimizer.optimize(prefix, suffix)
-    optimized_string = optimized_string[:len(optimized_string)-len(suffix)]
+    with record(name, enabled=instrument) as recorder:
+        optimized_ids, predicted_prefix_loss, predicted_suffix_loss = optimizer.optimize_tokens(prefix_ids, suffix_ids)
     t2 = time.time()
-    predicted_prefix_loss, predicted_suffix_loss = forward_loss(model, (optimized_string, suffix), tokenizer)
-    return optimized_string, predicted_prefix_loss, predicted_suffix_loss, t2-t1
-
+    optimized_string = tokenizer.decode(optimized_ids)
+    instrumentation = recorder.to_dict() if recorder is not None else None
+    return optimized_string, predicted_prefix_loss, predicted_suffix_loss, t2-t1, instrumentation
 
-def main():
-    args = parse_arguments()
 
+def load_tokenizer():
     tokenizer = AutoTokenizer.from_pretrained("afterless/reverse-pythia-160m")
-    if "ON_GREENE" in os.environ.keys():
-        model = GPTNeoXForCausalLM.from_pretrained(f"EleutherAI/pythia-{args.model_size}-deduped",cache_dir="/scratch/adi224/hf/models/").cuda()
-    else:
-        model = GPTNeoXForCausalLM.from_pretrained(f"EleutherAI/pythia-{args.model_size}-deduped").cuda()
-
-    reverse_model = GPTNeoXForCausalLM.from_pretrained("afterless/reverse-pythia-160m").cuda()
     tokenizer.eos_token = '<|endoftext|>'
     tokenizer.pad_token = tokenizer.eos_token
+    return tokenizer
+
 
+def load_pairs(args, tokenizer):
     if args.dataset == "allenai/real-toxicity-prompts":
         data = load_dataset(args.dataset)
         ps_pairs = [(d['prompt']['text'],d['continuation']['text']) for d in data['train'] if (d['continuation']['severe_toxicity'] is not None and d['continuation']['severe_toxicity']>0.85)]
@@ -72,77 +97,159 @@ def main():
         print(next(pairs))
         ps_pairs = list(pairs)
         dataset_name = "pile_val"
+    return ps_pairs, dataset_name
+
+
+def init_worker(args):
+    num_threads = args.num_threads
+    if num_threads is None and args.num_workers > 1:
+        # Split the cores between workers instead of oversubscribing them
+        num_threads = max(1, (os.cpu_count() or 1) // args.num_workers)
+    runtime = set_runtime(InferenceRuntime(
+        device=args.device,
+        dtype=args.dtype,
+        compile=args.compile,
+        num_threads=num_threads,
+        # Workers plan their batches against their share of the memory
+        num_processes=args.num_workers,
+        memory_budget=int(args.memory_budget_gb * 2**30) if args.memory_budget_gb else None,
+    ))
+
+    tokenizer = load_tokenizer()
+    if "ON_GREENE" in os.environ.keys():
+        model = GPTNeoXForCausalLM.from_pretrained(f"EleutherAI/pythia-{args.model_size}-deduped",cache_dir="/scratch/adi224/hf/models/")
+    else:
+        model = GPTNeoXForCausalLM.from_pretrained(f"EleutherAI/pythia-{args.model_size}-deduped")
+    model = runtime.prepare(model)
 
+    reverse_model = runtime.prepare(GPTNeoXForCausalLM.from_pretrained("afterless/reverse-pythia-160m"))
+    screening_model = None
+    if args.screening_model_size is not None:
+        screening_model = runtime.prepare(GPTNeoXForCausalLM.from_pretrained(f"EleutherAI/pythia-{args.screening_model_size}-deduped"))
+    screening = {"screening_model": screening_model, "screening_fraction": args.screening_fraction}
 
     temp = None #None for default reversal with uniform sampling
     
-    optimizers = {
-        "gcg": GreedyCoordinateGradient(model, tokenizer, prefix_loss_weight=0),
-        "reverse_model": ReverseModelSamplerBeamSearch(model, reverse_model, tokenizer),
-        "bayesian_reversal": ReversalLMPrior(model, reverse_model, tokenizer, batch_size=args.vocab_batch_size, num_top_tokens=args.reversal_num_tokens)
+    WORKER["args"] = args
+    WORKER["tokenizer"] = tokenizer
+    WORKER["model"] = model
+    WORKER["optimizers"] = {
+        "gcg": GreedyCoordinateGradient(
+            model,
+            tokenizer,
+            prefix_loss_weight=0,
+            n_restarts=args.gcg_restarts,
+            patience=args.gcg_patience,
+            min_delta=args.gcg_min_delta,
+            target_loss=args.gcg_target_loss,
+            time_budget=args.gcg_time_budget,
+            stop_on_greedy_match=args.gcg_stop_on_greedy_match
+        ),
+        "reverse_model": ReverseModelSamplerBeamSearch(model, reverse_model, tokenizer, **screening),
+        "bayesian_reversal": ReversalLMPrior(model, reverse_model, tokenizer, batch_size=args.vocab_batch_size, num_top_tokens=args.reversal_num_tokens, **screening)
     }
-    
-    output_stats = {}
-    output_stats["parameters"] = {}
-    args_dict = vars(args)
-    output_stats["parameters"].update(args_dict)
-    
-    for p, pair in enumerate(tqdm(ps_pairs[:args.eval_size])):
+
+
+def run_task(task):
+    # One (pair, optimizer) evaluation, seeded by its position so results don't depend on scheduling
+    p, pair, prefix_tokens, suffix_tokens, len_prefix, opt_name = task
+    args, tokenizer, model = WORKER["args"], WORKER["tokenizer"], WORKER["model"]
+    prefix, suffix = pair
+    suffix_ids = torch.tensor(suffix_tokens)
+    torch.manual_seed(args.seed + p)
+    prefix_loss, suffix_loss = forward_loss_tokens(model, torch.tensor(prefix_tokens), suffix_ids)
+    rand_prefix = rand_init_tokens(len_prefix, tokenizer)
+    optimizer = WORKER["optimizers"][opt_name]
+    if args.checkpoint_dir is not None and hasattr(optimizer, "checkpoint_path"):
+        optimizer.checkpoint_path = os.path.join(args.checkpoint_dir, f'{opt_name}_{p}.pt')
+
+    optimized_string, predicted_prefix_loss, predicted_suffix_loss, dt, stats = get_statistics(
+        rand_prefix,
+        suffix_ids,
+        optimizer,
+        model,
+        tokenizer,
+        name=opt_name,
+        instrument=args.instrument
+    )
+    return {
+        "pair": p,
+        "optimizer": opt_name,
+        "suffix": suffix,
+        "gt_prefix": prefix,
+        "gt_prefix_loss": prefix_loss.item(),
+        "gt_suffix_loss": suffix_loss.item(),
+        "prefix": optimized_string,
+        "prefix_loss": predicted_prefix_loss.item(),
+        "suffix_loss": predicted_suffix_loss.item(),
+        "time": dt,
+        "instrumentation": stats,
+        # Per-epoch losses and stop reason of every GCG restart
+        "trace": optimizer.history[0] if getattr(optimizer, "history", None) else None,
+    }
+
+
+def run_tasks(tasks, args):
+    if args.num_workers == 1:
+        init_worker(args)
+        for task in tasks:
+            yield run_task(task)
+        return
+    # spawn, so that CUDA can be initialised in the workers
+    context = multiprocessing.get_context("spawn")
+    with context.Pool(args.num_workers, initializer=init_worker, initargs=(args,)) as pool:
+        yield from pool.imap_unordered(run_task, tasks)
+
+
+def main():
+    args = parse_arguments()
+    tokenizer = load_tokenizer()
+    ps_pairs, dataset_name = load_pairs(args, tokenizer)
+    run = f'{args.filename_prefix}reversal_results_{dataset_name}_{args.model_size}_{args.eval_size}sample'
+    # Finished (pair, optimizer) results are written to the store, a restarted run skips them
+    store = ResultStore(args.results_dir)
+    parameters = vars(args)
+
+    opt_names = ["gcg", "reverse_model", "bayesian_reversal"]
+    done = store.completed(run)
+    tasks = []
+    for p, pair in enumerate(ps_pairs[:args.eval_size]):
         
         prefix, suffix = pair
         prefix_tokens = tokenizer.encode(prefix)
         suffix_tokens = tokenizer.encode(suffix)
+        len_prefix = len(prefix_tokens)
         
-        if len(prefix_tokens) > args.num_prefix_tokens:
-            prefix_tokens = prefix_tokens[-args.num_prefix_tokens:]
-        if len(prefix_tokens) < args.num_prefix_tokens:
+        if len_prefix > args.num_prefix_tokens:
+            len_prefix = args.num_prefix_tokens
+        if len_prefix < args.num_prefix_tokens:
             continue
         # if args.dataset == "pile"
         # if len(suffix_tokens) < args.num_suffix_tokens: continue
-        prefix_loss, suffix_loss = forward_loss(model, pair, tokenizer)
-        
-        output_stats[suffix] = {
-            "gt_prefix": prefix,
-            "gt_prefix_loss": prefix_loss.item(),
-            "gt_suffix_loss": suffix_loss.item(),
-            "prompt_opts": {
-                opt: {} for opt in optimizers
-            }
-        }
-
-        for opt_name, optimizer in optimizers.items():
-            
-            len_prefix = len(prefix_tokens)
-            rand_prefix = rand_init(len_prefix, tokenizer)
-            
-            optimized_string, predicted_prefix_loss, predicted_suffix_loss, dt = get_statistics(
-                rand_prefix,
-                suffix,
-                optimizer,
-                model,
-                tokenizer
-            )
-            
-            output_stats[suffix]["prompt_opts"][opt_name] = {
-                "prefix": optimized_string,
-                "prefix_loss": predicted_prefix_loss.item(),
-                "suffix_loss": predicted_suffix_loss.item(),
-                "time": dt
-            }
-            print("method: ", opt_name, "time: ", dt, "suffix_loss:", predicted_suffix_loss.item())
-
-        # all_reversal_losses.append(reversal_loss)
-        # all_reversal_naturals.append(reversal_naturals)
-        # all_reversal_prefixes.append(reversal_found_prefixes)
-        # print(f'Average tokenwise accuracy is {sum(tokenwise_acc)/len(tokenwise_acc)}')
-        # print(f'Average loss is {sum(reversal_loss)/len(reversal_loss)}')
-
-        if p in [10,20,50]:
-            with open(f'data/{args.filename_prefix}temp_{p}_reversal_results_{dataset_name}_{args.model_size}_{args.eval_size}sample.pkl', 'wb') as f:
-                pickle.dump(output_stats, f)
-
-    with open(f'data/{args.filename_prefix}reversal_results_{dataset_name}_{args.model_size}_{args.eval_size}sample.pkl', 'wb') as f:
-        pickle.dump(output_stats, f)
+        tasks += [(p, pair, prefix_tokens, suffix_tokens, len_prefix, opt_name) for opt_name in opt_names if (p, opt_name) not in done]
+    print(f'{len(done)} results of {run} already in {args.results_dir}, {len(tasks)} left')
+
+    # Every result is written as soon as it finishes, the parts are merged once the run is done
+    rows = []
+    try:
+        for result in tqdm(run_tasks(tasks, args), total=len(tasks)):
+            rows.append(to_row(result, run, parameters))
+            if len(rows) >= args.flush_every:
+                store.append(rows)
+                rows = []
+            print("method: ", result["optimizer"], "time: ", result["time"], "suffix_loss:", result["suffix_loss"])
+    finally:
+        store.append(rows)
+    store.compact()
+
+    if args.pickle:
+        rows = store.read_run(run).to_pylist()
+        with open(f'data/{run}.pkl', 'wb') as f:
+            pickle.dump(to_output_stats(rows, parameters), f)
+        instrumentation = to_instrumentation(rows)
+        if instrumentation:
+            with open(f'data/{run}.instrumentation.json', 'w') as f:
+                json.dump(instrumentation, f, indent=2)
         
 if __name__ == "__main__":
     main()
@@ -2,3 +2,10 @@ from src.utils import *
 from src.bayesian_sampling import ReversalLMPrior, ReversalEmpiricalPrior
 from src.gcg import GreedyCoordinateGradient
 from src.rm_sampling import ReverseModelSampler, ReverseModelSamplerBeamSearch
+from src.instrumentation import Recorder, record
+from src.results import ResultStore, load_legacy_results, to_instrumentation, to_output_stats, to_row
+from src.token_filters import get_token_mask, tokenizer_hash
+from src.token_counts import count_shard, counts_to_probs, merge_counts
+from src.priors import PriorStore
+from src.transition_index import TransitionIndex, build_transition_index, load_transition_index
+from src.runtime import InferenceRuntime, get_runtime, set_runtime
@@ -9,6 +9,10 @@ from tqdm import tqdm
 from transformers import (AutoModelForCausalLM, AutoTokenizer,
                           GPTNeoXForCausalLM)
 from src.utils import *
+from src.checkpoint import SamplerCheckpoint, remove_checkpoint
+from src.instrumentation import count_forward, phase
+from src.priors import dilute_prior
+from src.runtime import inference_context
 
 
 class ReversalLMPrior:
@@ -20,6 +24,11 @@ class ReversalLMPrior:
         tokenizer: AutoTokenizer,
         batch_size=1024,
         num_top_tokens: int = 10_000,
+        checkpoint_path: str = None,
+        prune_top_k: int = None,
+        prune_mass: float = None,
+        screening_model: AutoModelForCausalLM = None,
+        screening_fraction: float = 0.1,
     ):
 
         self.model = model
@@ -27,6 +36,16 @@ class ReversalLMPrior:
         self.tokenizer = tokenizer
         self.batch_size = batch_size
         self.num_top_tokens = num_top_tokens
+        # Partially sampled prefixes are saved here after every token and resumed from
+        self.checkpoint_path = checkpoint_path
+        # Opt-in pruning of the candidates scored at every step, see prune_candidates
+        self.prune_top_k = prune_top_k
+        self.prune_mass = prune_mass
+        # Cheaper model scoring every candidate first, only the top screening_fraction is scored by model
+        self.screening_model = screening_model
+        self.screening_fraction = screening_fraction
+        # Screening posterior mass discarded at every step of the last optimize call
+        self.discarded_mass = []
 
     def sample_proposals(
         self,
@@ -46,8 +65,14 @@ class ReversalLMPrior:
             vocab_batch_size=self.batch_size,
             temperature=temperature,
             dilution=0.3,
-            device="cuda",
-            num_top_tokens=self.num_top_tokens
+            device=self.model.device,
+            num_top_tokens=self.num_top_tokens,
+            prune_top_k=self.prune_top_k,
+            prune_mass=self.prune_mass,
+            checkpoint_path=self.checkpoint_path,
+            screening_model=self.screening_model,
+            screening_fraction=self.screening_fraction,
+            discarded_mass=self.discarded_mass
         )
         return tokens
 
@@ -59,12 +84,61 @@ class ReversalLMPrior:
         temperature=0,
     ):
         # Parse input strings into tokens
-        initial_inputs = self.tokenizer.encode(initial_input, return_tensors="pt").cuda()
-        initial_targets = self.tokenizer.encode(target_string, return_tensors="pt").cuda()
+        initial_inputs = self.tokenizer.encode(initial_input, return_tensors="pt")[0]
+        initial_targets = self.tokenizer.encode(target_string, return_tensors="pt")[0]
+        prefix_ids, _, _ = self.optimize_tokens(initial_inputs, initial_targets, use_prefix_loss, temperature)
+        return self.tokenizer.decode(torch.cat((prefix_ids, initial_targets.to(prefix_ids.device))))
+
+    def optimize_tokens(
+        self,
+        prefix_ids,
+        target_ids,
+        use_prefix_loss=True,
+        temperature=0,
+    ):
+        # Token-level entry point, returns the sampled prefix ids with their prefix and suffix losses
+        self.discarded_mass = []
+        initial_targets = target_ids.unsqueeze(0).to(self.model.device)
         # Sample proposals
-        proposals = self.sample_proposals(initial_inputs.shape[-1], initial_targets, temperature=temperature)
-        # Choose the proposal with the lowest loss
-        return self.tokenizer.decode(proposals[0])
+        proposals = self.sample_proposals(prefix_ids.shape[-1], initial_targets, temperature=temperature)
+        prefix_ids = proposals[0, :prefix_ids.shape[-1]]
+        prefix_loss, suffix_loss = forward_loss_tokens(self.model, prefix_ids, target_ids)
+        return prefix_ids, prefix_loss, suffix_loss
+
+    def optimize_batch(
+        self,
+        initial_inputs,
+        target_strings,
+        temperature=0,
+    ):
+        # Suffixes whose prefixes have the same number of tokens are reversed together in shared batches
+        self.discarded_mass = []
+        prefix_lengths = [len(self.tokenizer.encode(initial_input)) for initial_input in initial_inputs]
+        targets = [self.tokenizer.encode(target, return_tensors="pt")[0].to(self.model.device) for target in target_strings]
+        outputs = [None] * len(targets)
+        for length in sorted(set(prefix_lengths)):
+            group = [j for j, l in enumerate(prefix_lengths) if l == length]
+            tokens, _ = sample_reverse_dynamics_reverse_prior_batch(
+                self.model,
+                self.reverse_model,
+                prefix_length=length,
+                tokenized_suffixes=[targets[j] for j in group],
+                vocab_batch_size=self.batch_size,
+                temperature=temperature,
+                dilution=0.3,
+                device=self.model.device,
+                num_top_tokens=self.num_top_tokens,
+                checkpoint_path=self.checkpoint_path,
+                checkpoint_group=length,
+                screening_model=self.screening_model,
+                screening_fraction=self.screening_fraction,
+                discarded_mass=self.discarded_mass
+            )
+            for j, proposal in zip(group, tokens):
+                outputs[j] = self.tokenizer.decode(proposal)
+        # Every group keeps its state under its own key until all of them finished
+        remove_checkpoint(self.checkpoint_path)
+        return outputs
     
 
 class ReversalEmpiricalPrior:
@@ -77,7 +151,13 @@ class ReversalEmpiricalPrior:
         batch_size=1024,
         reverse_model: AutoModelForCausalLM = None,
         num_top_tokens: int = 10_000,
-
+        checkpoint_path: str = None,
+        dilution: float = 0.3,
+        transition_index=None,
+        prune_top_k: int = None,
+        prune_mass: float = None,
+        screening_model: AutoModelForCausalLM = None,
+        screening_fraction: float = 0.1,
     ):
 
         self.model = model
@@ -87,6 +167,28 @@ class ReversalEmpiricalPrior:
 
         self.reverse_model = reverse_model
         self.num_top_tokens = num_top_tokens
+        # Partially sampled prefixes are saved here after every token and resumed from
+        self.checkpoint_path = checkpoint_path
+        # Opt-in pruning of the candidates scored at every step, see prune_candidates
+        self.prune_top_k = prune_top_k
+        self.prune_mass = prune_mass
+        # Mixed into dist at every call, 0 when dist already is a diluted prior
+        self.dilution = dilution
+        # TransitionIndex shortlisting num_top_tokens candidates per step when there is no reverse model
+        if transition_index is not None:
+            transition_index.check_tokenizer(tokenizer)
+        self.transition_index = transition_index
+        # Cheaper model scoring every candidate first, only the top screening_fraction is scored by model
+        self.screening_model = screening_model
+        self.screening_fraction = screening_fraction
+        # Screening posterior mass discarded at every step of the last optimize call
+        self.discarded_mass = []
+
+    @classmethod
+    def from_store(cls, model, tokenizer, store, name, version=None, smoothing=None, dilution=0.3, **kwargs):
+        # Memory-mapped prior from a PriorStore, with the dilution precomputed instead of applied every call
+        dist = store.load(name, version, smoothing=smoothing, dilution=dilution, tokenizer=tokenizer)
+        return cls(model, dist, tokenizer, dilution=0.0, **kwargs)
 
     def sample_proposals(
         self,
@@ -105,10 +207,17 @@ class ReversalEmpiricalPrior:
             tokenized_suffix=target_ids,
             vocab_batch_size=self.batch_size,
             temperature=temperature,
-            dilution=0.3,
-            device="cuda",
+            dilution=self.dilution,
+            device=self.model.device,
             reverse_model=self.reverse_model,
-            num_top_tokens=self.num_top_tokens
+            num_top_tokens=self.num_top_tokens,
+            prune_top_k=self.prune_top_k,
+            prune_mass=self.prune_mass,
+            checkpoint_path=self.checkpoint_path,
+            transition_index=self.transition_index,
+            screening_model=self.screening_model,
+            screening_fraction=self.screening_fraction,
+            discarded_mass=self.discarded_mass
         )
         return tokens
 
@@ -119,24 +228,71 @@ class ReversalEmpiricalPrior:
         temperature=0.7,
     ):
         # Parse input strings into tokens
-        initial_inputs = self.tokenizer.encode(initial_input, return_tensors="pt").cuda()
-        initial_targets = self.tokenizer.encode(target_string, return_tensors="pt").cuda()
+        initial_inputs = self.tokenizer.encode(initial_input, return_tensors="pt")[0]
+        initial_targets = self.tokenizer.encode(target_string, return_tensors="pt")[0]
+        prefix_ids, _, _ = self.optimize_tokens(initial_inputs, initial_targets, temperature)
+        return self.tokenizer.decode(torch.cat((prefix_ids, initial_targets.to(prefix_ids.device))))
+
+    def optimize_tokens(
+        self,
+        prefix_ids,
+        target_ids,
+        temperature=0.7,
+    ):
+        # Token-level entry point, returns the sampled prefix ids with their prefix and suffix losses
+        self.discarded_mass = []
+        initial_targets = target_ids.unsqueeze(0).to(self.model.device)
         # Sample proposals
-        proposals = self.sample_proposals(initial_inputs.shape[-1], initial_targets, temperature=temperature)
-        # Choose the proposal with the lowest loss
-        return self.tokenizer.decode(proposals[0])
+        proposals = self.sample_proposals(prefix_ids.shape[-1], initial_targets, temperature=temperature)
+        prefix_ids = proposals[0, :prefix_ids.shape[-1]]
+        prefix_loss, suffix_loss = forward_loss_tokens(self.model, prefix_ids, target_ids)
+        return prefix_ids, prefix_loss, suffix_loss
 
+    def optimize_batch(
+        self,
+        initial_inputs,
+        target_strings,
+        temperature=0.7,
+    ):
+        # Suffixes whose prefixes have the same number of tokens are reversed together in shared batches
+        self.discarded_mass = []
+        prefix_lengths = [len(self.tokenizer.encode(initial_input)) for initial_input in initial_inputs]
+        targets = [self.tokenizer.encode(target, return_tensors="pt")[0].to(self.model.device) for target in target_strings]
+        outputs = [None] * len(targets)
+        for length in sorted(set(prefix_lengths)):
+            group = [j for j, l in enumerate(prefix_lengths) if l == length]
+            tokens, _ = sample_reverse_dynamics_batch(
+                self.model,
+                self.dist,
+                prefix_length=length,
+                tokenized_suffixes=[targets[j] for j in group],
+                vocab_batch_size=self.batch_size,
+                temperature=temperature,
+                dilution=self.dilution,
+                device=self.model.device,
+                reverse_model=self.reverse_model,
+                num_top_tokens=self.num_top_tokens,
+                checkpoint_path=self.checkpoint_path,
+                checkpoint_group=length,
+                transition_index=self.transition_index,
+                screening_model=self.screening_model,
+                screening_fraction=self.screening_fraction,
+                discarded_mass=self.discarded_mass
+            )
+            for j, proposal in zip(group, tokens):
+                outputs[j] = self.tokenizer.decode(proposal)
+        # Every group keeps its state under its own key until all of them finished
+        remove_checkpoint(self.checkpoint_path)
+        return outputs
 
-def get_cond_logprob(input_ids, model):
-    # Get conditional logprobs
-    with torch.no_grad():
-        logprobs = torch.nn.functional.log_softmax(
-            model(input_ids=input_ids[:,:-1]).logits, dim=-1
-        )
-    # Get the log probabilities corresponding to the words in input_ids
-    relevant_logprobs = torch.gather(
-        logprobs, 2, input_ids.unsqueeze(-1)[:, 1:]
-    ).squeeze(-1)
+
+def get_cond_logprob(input_ids, model, attention_mask=None):
+    # Get the conditional log probabilities of the words in input_ids
+    with inference_context():
+        relevant_logprobs = token_logprobs(model, input_ids, attention_mask)
+    # Right padding does not count towards the sequence probability
+    if attention_mask is not None:
+        relevant_logprobs = relevant_logprobs * attention_mask[:, 1:]
     # Sum log probabilities over the sequence length dimension
     sum_log_probs = relevant_logprobs.sum(dim=1)
     return sum_log_probs
@@ -149,53 +305,164 @@ def get_logprob(input_ids, model, stationary_dist):
     return logprob
 
 
-def compute_posterior(
+def score_candidates(
     model,
     stationary_dist,
     tokenized_suffix,
+    candidates,
     vocab_batch_size=1024,
-    device="cuda",
-    indices=None,
     disable_tqdm=True
 ):
-    model.eval()
-    vocab_size = stationary_dist.shape[0]
-    posterior = []
-    
-    if indices is None:
-        full_indices = torch.arange(0, vocab_size, device=device)
-    else:
-        full_indices = indices.to(device)
-
-    total_batches = math.ceil(full_indices.shape[-1] / vocab_batch_size)
+    # Unnormalized log posterior of every candidate first token given the suffix
+    scores = []
+    total_batches = math.ceil(candidates.shape[-1] / vocab_batch_size)
 
     for batch_num in tqdm(range(total_batches),disable=disable_tqdm):
         start_idx = batch_num * vocab_batch_size
-        end_idx = min(start_idx + vocab_batch_size, vocab_size)
+        end_idx = start_idx + vocab_batch_size
 
-        batch_indices = full_indices[start_idx:end_idx]
+        batch_indices = candidates[start_idx:end_idx]
         v_sentences = torch.cat(
             (batch_indices.unsqueeze(1), tokenized_suffix.repeat(batch_indices.size(0), 1)),
             dim=-1,
         )
 
-        posterior.append(get_logprob(v_sentences, model, stationary_dist))
+        scores.append(get_logprob(v_sentences, model, stationary_dist))
     
-    posterior = torch.cat(posterior)
-    posterior[torch.isnan(posterior)] = -100
-    posterior = F.log_softmax(posterior, dim=-1)
+    scores = torch.cat(scores)
+    scores[torch.isnan(scores)] = -100
+    return scores
+
+
+def prune_candidates(
+    model,
+    stationary_dist,
+    tokenized_suffix,
+    candidates,
+    vocab_batch_size=1024,
+    top_k=None,
+    mass_tolerance=None,
+):
+    # Log-probabilities only decrease as more suffix tokens are scored, so the score of a candidate on the
+    # first w suffix tokens upper-bounds its score on the full suffix. Batches of candidates, most probable
+    # under the prior first, are scored on a doubling window of the suffix that is extended through the KV
+    # cache, and a row is dropped as soon as its bound can no longer matter:
+    # - top_k: the bound is below the k-th best full score of the candidates scored so far (exact)
+    # - mass_tolerance: the bounds of all dropped candidates sum to at most this much posterior mass, relative
+    #   to the full scores so far, which lower-bound the normalizer
+    # Returns the surviving candidates with their full scores, no token is scored twice.
+    suffix = tokenized_suffix.reshape(-1).to(candidates.device)
+    suffix_length = suffix.shape[-1]
+    log_prior = torch.log(stationary_dist[candidates])
+    order = log_prior.argsort(descending=True)
+    kept, kept_scores = [], []
+    full_scores = log_prior.new_empty(0)
+    discarded_mass = 0.0
+    for start in range(0, order.shape[-1], vocab_batch_size):
+        rows = order[start:start + vocab_batch_size]
+        sentences = torch.cat((candidates[rows].unsqueeze(1), suffix.expand(rows.shape[-1], -1)), dim=-1)
+        scores = log_prior[rows]
+        past_key_values = None
+        position = 0
+        window = 1
+        while True:
+            # Inputs sentences[:, position:end] predict suffix[position:end]
+            end = min(window, suffix_length)
+            input_ids = sentences[:, position:end]
+            with inference_context():
+                count_forward(input_ids)
+                outputs = model.base_model(input_ids=input_ids, past_key_values=past_key_values, use_cache=True)
+                scores = scores + gather_logprobs(model, outputs.last_hidden_state, sentences[:, position + 1:end + 1]).sum(dim=-1)
+            scores = torch.nan_to_num(scores, nan=-100.0)
+            past_key_values = outputs.past_key_values
+            position = end
+            if position == suffix_length:
+                break
+            keep = torch.ones_like(scores, dtype=torch.bool)
+            if top_k is not None and full_scores.shape[-1] >= top_k:
+                keep &= scores >= full_scores.topk(top_k).values[-1]
+            if mass_tolerance is not None and full_scores.shape[-1] > 0:
+                ascending = scores.argsort()
+                upper_mass = torch.exp(scores[ascending] - torch.logsumexp(full_scores, dim=-1)).cumsum(dim=-1) + discarded_mass
+                drop = ascending[upper_mass <= mass_tolerance]
+                if drop.shape[-1] > 0:
+                    keep[drop] = False
+                    discarded_mass = upper_mass[drop.shape[-1] - 1].item()
+            if not keep.all():
+                survivors = keep.nonzero().squeeze(1)
+                if survivors.shape[-1] == 0:
+                    break
+                sentences, scores = sentences[survivors], scores[survivors]
+                past_key_values = reorder_past_key_values(past_key_values, survivors)
+            window *= 2
+        if position == suffix_length:
+            kept.append(sentences[:, 0])
+            kept_scores.append(scores)
+            full_scores = torch.cat((full_scores, scores))
+    return torch.cat(kept), torch.cat(kept_scores)
+
+
+def compute_posterior(
+    model,
+    stationary_dist,
+    tokenized_suffix,
+    vocab_batch_size=1024,
+    device=None,
+    indices=None,
+    disable_tqdm=True,
+    prune_top_k=None,
+    prune_mass=None,
+    screening_model=None,
+    screening_fraction=0.1,
+    discarded_mass=None
+):
+    # With a screening_model, every candidate is scored by it first and only the top screening_fraction
+    # by the model. The screening posterior mass of the rest is reported and appended to discarded_mass.
+    if device is None:
+        device = model.device
+    with phase("posterior"):
+        model.eval()
+        vocab_size = stationary_dist.shape[0]
     
-    if indices is not None:
-        new_post = torch.ones_like(stationary_dist) * -100000
-        new_post[indices] = posterior
-        return new_post
-    else:
-        return posterior
+        if indices is None:
+            full_indices = torch.arange(0, vocab_size, device=device)
+        else:
+            full_indices = indices.to(device)
+
+        if screening_model is not None:
+            with phase("screening"):
+                screening_model.eval()
+                screening_scores = score_candidates(screening_model, stationary_dist, tokenized_suffix, full_indices, vocab_batch_size, disable_tqdm)
+                top, mass = screen_candidates(screening_scores, screening_fraction)
+            record_discarded_mass(mass, discarded_mass)
+            indices = full_indices = full_indices[top]
+
+        if prune_top_k is not None or prune_mass is not None:
+            # Only survivors get a posterior, every other candidate is treated as excluded
+            indices, posterior = prune_candidates(
+                model,
+                stationary_dist,
+                tokenized_suffix,
+                full_indices,
+                vocab_batch_size,
+                top_k=prune_top_k,
+                mass_tolerance=prune_mass
+            )
+        else:
+            posterior = score_candidates(model, stationary_dist, tokenized_suffix, full_indices, vocab_batch_size, disable_tqdm)
+        posterior = F.log_softmax(posterior, dim=-1)
+    
+        if indices is not None:
+            new_post = torch.ones_like(stationary_dist) * -100000
+            new_post[indices] = posterior
+            return new_post
+        else:
+            return posterior
 
 
 def sample_with_temp(logits, temperature):
     if temperature == 0:
-        p = logits.argmax()
+        p = logits.argmax(dim=-1)
     else:
         p = torch.distributions.Categorical(
             logits = logits / temperature
@@ -211,22 +478,39 @@ def sample_reverse_dynamics(
     vocab_batch_size=1024,
     temperature=1.0,
     dilution=0.0,
-    device="cuda",
+    device=None,
     reverse_model=None,
     num_top_tokens=10_000,
-    disable_tqdm=True
+    disable_tqdm=True,
+    prune_top_k=None,
+    prune_mass=None,
+    checkpoint_path=None,
+    checkpoint_every=1,
+    checkpoint_group=None,
+    transition_index=None,
+    screening_model=None,
+    screening_fraction=0.1,
+    discarded_mass=None
 ):
+    if device is None:
+        device = model.device
     splus = tokenized_suffix
     full_logits = []
     prior_dist = stationary_dist.to(device)
     
-    uniform_dist = torch.ones_like(prior_dist) / prior_dist.shape[0]
-    prior_dist = prior_dist * (1-dilution) + uniform_dist * dilution
+    prior_dist = dilute_prior(prior_dist, dilution)
     
-    for i in range(prefix_length):
+    checkpoint = SamplerCheckpoint(checkpoint_path, tokenized_suffix, prefix_length, checkpoint_every, checkpoint_group)
+    start, full_logits, tensors = checkpoint.resume(full_logits, device, splus=splus)
+    splus = tensors["splus"]
+    
+    for i in range(start, prefix_length):
         
         if reverse_model is not None:
             _, possible_tokens = get_reverse_model_probs(reverse_model, splus, num_top_tokens)
+        elif transition_index is not None:
+            # Without a reverse model, only the num_top_tokens most plausible predecessors of splus[0] are scored
+            possible_tokens = transition_index.shortlist(splus[0, 0], num_top_tokens, prior_dist)
         else:
             possible_tokens = None
         
@@ -236,7 +520,13 @@ def sample_reverse_dynamics(
             tokenized_suffix=splus,
             vocab_batch_size=vocab_batch_size,
             device=device,
-            disable_tqdm=disable_tqdm
+            indices=possible_tokens,
+            disable_tqdm=disable_tqdm,
+            prune_top_k=prune_top_k,
+            prune_mass=prune_mass,
+            screening_model=screening_model,
+            screening_fraction=screening_fraction,
+            discarded_mass=discarded_mass
         )
 
         full_logits = [logits,] + full_logits
@@ -245,13 +535,17 @@ def sample_reverse_dynamics(
             temperature
         )
         splus = torch.cat((p.unsqueeze(0).unsqueeze(0), splus), dim=-1)
+        checkpoint.update(i + 1, full_logits, splus=splus)
         
+    checkpoint.finish()
     return splus, torch.stack(full_logits)
 
 
 def get_reverse_model_probs(reverse_model, input_ids, num_top_tokens=None, filter_prob=None):
     input_ids = torch.flip(input_ids, (1,))
-    outputs = reverse_model(input_ids).logits[0,-1,:]
+    with phase("reverse_model_prior"), inference_context():
+        count_forward(input_ids)
+        outputs = reverse_model(input_ids).logits[0,-1,:].float()
     probs = F.softmax(outputs, dim=-1)
     if filter_prob is not None:
         filter = (probs > filter_prob)
@@ -273,22 +567,35 @@ def sample_reverse_dynamics_reverse_prior(
     vocab_batch_size=1024,
     temperature=1.0,
     dilution=0.0,
-    device="cuda",
+    device=None,
     num_top_tokens=None,
     filter_prob=None,
-    disable_tqdm=True
+    disable_tqdm=True,
+    prune_top_k=None,
+    prune_mass=None,
+    checkpoint_path=None,
+    checkpoint_every=1,
+    checkpoint_group=None,
+    screening_model=None,
+    screening_fraction=0.1,
+    discarded_mass=None
 ):
+    if device is None:
+        device = model.device
     splus = tokenized_suffix
     full_logits = []
     
-    for i in range(prefix_length):
+    checkpoint = SamplerCheckpoint(checkpoint_path, tokenized_suffix, prefix_length, checkpoint_every, checkpoint_group)
+    start, full_logits, tensors = checkpoint.resume(full_logits, device, splus=splus)
+    splus = tensors["splus"]
+    
+    for i in range(start, prefix_length):
         
         # print(tokenizer.decode(splus))
 
         prior_dist, possible_tokens = get_reverse_model_probs(reverse_model, splus, num_top_tokens=num_top_tokens, filter_prob=filter_prob)
         
-        uniform_dist = torch.ones_like(prior_dist) / prior_dist.shape[0]
-        prior_dist = prior_dist * (1-dilution) + uniform_dist * dilution
+        prior_dist = dilute_prior(prior_dist, dilution)
         
         logits = compute_posterior(
             model=model,
@@ -297,7 +604,12 @@ def sample_reverse_dynamics_reverse_prior(
             vocab_batch_size=vocab_batch_size,
             device=device,
             indices=possible_tokens,
-            disable_tqdm=disable_tqdm
+            disable_tqdm=disable_tqdm,
+            prune_top_k=prune_top_k,
+            prune_mass=prune_mass,
+            screening_model=screening_model,
+            screening_fraction=screening_fraction,
+            discarded_mass=discarded_mass
         )
         full_logits = [logits,] + full_logits
         p = sample_with_temp(
@@ -305,19 +617,283 @@ def sample_reverse_dynamics_reverse_prior(
             temperature
         )
         splus = torch.cat((p.unsqueeze(0).unsqueeze(0), splus), dim=-1)
+        checkpoint.update(i + 1, full_logits, splus=splus)
         
+    checkpoint.finish()
     return splus, torch.stack(full_logits)
 
 
+def pad_suffixes(tokenized_suffixes, pad_token_id=0):
+    # Right-pad a list of 1d token tensors into a [N, max_len] batch and its attention mask
+    max_len = max(suffix.shape[-1] for suffix in tokenized_suffixes)
+    device = tokenized_suffixes[0].device
+    padded = torch.full((len(tokenized_suffixes), max_len), pad_token_id, dtype=torch.long, device=device)
+    mask = torch.zeros((len(tokenized_suffixes), max_len), dtype=torch.long, device=device)
+    for j, suffix in enumerate(tokenized_suffixes):
+        padded[j, :suffix.shape[-1]] = suffix.view(-1)
+        mask[j, :suffix.shape[-1]] = 1
+    return padded, mask
+
+
+def score_candidates_batch(
+    model,
+    stationary_dist,
+    tokenized_suffixes,
+    suffix_mask,
+    candidates,
+    vocab_batch_size=1024,
+    disable_tqdm=True
+):
+    # Unnormalized [N, K] log posteriors of the [N, K] candidates of N right-padded suffixes.
+    # Each forward batch holds up to vocab_batch_size pairs of the longest suffix worth of tokens, so pairs of
+    # shorter suffixes are packed more densely. A batch may span suffixes of the same length, never padding.
+    device = candidates.device
+    num_suffixes, num_candidates = candidates.shape
+    total_pairs = num_suffixes * num_candidates
+    lengths = suffix_mask.sum(dim=-1) + 1
+    max_tokens = vocab_batch_size * int(lengths.max())
+    # Pairs are suffix-major over the suffixes sorted by decreasing length
+    order = torch.argsort(lengths, descending=True, stable=True)
+    sorted_lengths = lengths[order].tolist()
+    # Pair index where the suffixes of every length end
+    length_ends = {length: (row + 1) * num_candidates for row, length in enumerate(sorted_lengths)}
+    starts = [0]
+    while starts[-1] < total_pairs:
+        length = sorted_lengths[starts[-1] // num_candidates]
+        starts.append(min(starts[-1] + max(1, max_tokens // length), length_ends[length]))
+
+    posterior = []
+    for start_idx, end_idx in tqdm(list(zip(starts[:-1], starts[1:])), disable=disable_tqdm):
+        pair_idx = torch.arange(start_idx, end_idx, device=device)
+        rows = order[pair_idx // num_candidates]
+        batch_candidates = candidates[rows, pair_idx % num_candidates]
+        length = sorted_lengths[start_idx // num_candidates]
+        v_sentences = torch.cat((batch_candidates.unsqueeze(1), tokenized_suffixes[rows]), dim=-1)[:, :length]
+        v_mask = torch.cat((torch.ones_like(rows).unsqueeze(1), suffix_mask[rows]), dim=-1)[:, :length]
+        logprob = torch.log(stationary_dist[rows, batch_candidates])
+        if length > 1:
+            logprob = logprob + get_cond_logprob(v_sentences, model, attention_mask=v_mask)
+        posterior.append(logprob)
+
+    posterior = torch.cat(posterior).view(num_suffixes, num_candidates)[torch.argsort(order)]
+    posterior[torch.isnan(posterior)] = -100
+    return posterior
+
+
+def compute_posterior_batch(
+    model,
+    stationary_dist,
+    tokenized_suffixes,
+    suffix_mask,
+    vocab_batch_size=1024,
+    device=None,
+    indices=None,
+    disable_tqdm=True,
+    screening_model=None,
+    screening_fraction=0.1,
+    discarded_mass=None
+):
+    # Posterior over the first token for N right-padded suffixes at once. stationary_dist is a shared [V] prior
+    # or one [N, V] prior per suffix, indices optionally restricts every suffix to its own [N, K] candidates.
+    # screening_model screens the candidates of every suffix as in compute_posterior.
+    if device is None:
+        device = model.device
+    with phase("posterior"):
+        model.eval()
+        num_suffixes = tokenized_suffixes.shape[0]
+        if stationary_dist.dim() == 1:
+            stationary_dist = stationary_dist.unsqueeze(0).expand(num_suffixes, -1)
+        vocab_size = stationary_dist.shape[-1]
+        tokenized_suffixes = tokenized_suffixes.to(device)
+        suffix_mask = suffix_mask.to(device)
+
+        if indices is None:
+            candidates = torch.arange(0, vocab_size, device=device).unsqueeze(0).expand(num_suffixes, -1)
+        else:
+            candidates = indices.to(device)
+
+        if screening_model is not None:
+            with phase("screening"):
+                screening_model.eval()
+                screening_scores = score_candidates_batch(screening_model, stationary_dist, tokenized_suffixes, suffix_mask, candidates, vocab_batch_size, disable_tqdm)
+                top, mass = screen_candidates(screening_scores, screening_fraction)
+            record_discarded_mass(mass, discarded_mass)
+            indices = candidates = candidates.gather(1, top)
+
+        posterior = score_candidates_batch(model, stationary_dist, tokenized_suffixes, suffix_mask, candidates, vocab_batch_size, disable_tqdm)
+        posterior = F.log_softmax(posterior, dim=-1)
+
+        if indices is not None:
+            new_post = torch.ones_like(stationary_dist) * -100000
+            new_post.scatter_(1, candidates, posterior)
+            return new_post
+        else:
+            return posterior
+
+
+def get_reverse_model_probs_batch(reverse_model, input_ids, attention_mask, num_top_tokens=None):
+    # Flip the real tokens of every right-padded row so that the padding stays on the right
+    lengths = attention_mask.sum(dim=-1)
+    positions = torch.arange(input_ids.shape[-1], device=input_ids.device)
+    flipped_idx = (lengths.unsqueeze(1) - 1 - positions).clamp(min=0)
+    flipped = torch.gather(input_ids, 1, flipped_idx) * attention_mask
+    with phase("reverse_model_prior"), inference_context():
+        count_forward(flipped)
+        outputs = reverse_model(flipped, attention_mask=attention_mask).logits.float()
+    outputs = outputs[torch.arange(input_ids.shape[0], device=input_ids.device), lengths - 1]
+    probs = F.softmax(outputs, dim=-1)
+    if num_top_tokens is not None:
+        top_tokens = outputs.topk(num_top_tokens, dim=-1).indices
+        return probs, top_tokens
+    else:
+        return probs, None
+
+
+def sample_reverse_dynamics_batch(
+    model,
+    stationary_dist,
+    prefix_length,
+    tokenized_suffixes,
+    vocab_batch_size=1024,
+    temperature=1.0,
+    dilution=0.0,
+    device=None,
+    reverse_model=None,
+    num_top_tokens=10_000,
+    disable_tqdm=True,
+    checkpoint_path=None,
+    checkpoint_every=1,
+    checkpoint_group=None,
+    transition_index=None,
+    screening_model=None,
+    screening_fraction=0.1,
+    discarded_mass=None
+):
+    # Batched sample_reverse_dynamics over a list of 1d suffix tensors
+    if device is None:
+        device = model.device
+    splus, splus_mask = pad_suffixes([suffix.to(device) for suffix in tokenized_suffixes])
+    full_logits = []
+    prior_dist = stationary_dist.to(device)
+    
+    prior_dist = dilute_prior(prior_dist, dilution)
+    
+    key = torch.stack((splus, splus_mask)).cpu()
+    checkpoint = SamplerCheckpoint(checkpoint_path, key, prefix_length, checkpoint_every, checkpoint_group)
+    start, full_logits, tensors = checkpoint.resume(full_logits, device, splus=splus, splus_mask=splus_mask)
+    splus, splus_mask = tensors["splus"], tensors["splus_mask"]
+    
+    for i in range(start, prefix_length):
+        
+        if reverse_model is not None:
+            _, possible_tokens = get_reverse_model_probs_batch(reverse_model, splus, splus_mask, num_top_tokens)
+        elif transition_index is not None:
+            possible_tokens = transition_index.shortlist(splus[:, 0], num_top_tokens, prior_dist)
+        else:
+            possible_tokens = None
+        
+        logits = compute_posterior_batch(
+            model=model,
+            stationary_dist=prior_dist,
+            tokenized_suffixes=splus,
+            suffix_mask=splus_mask,
+            vocab_batch_size=vocab_batch_size,
+            device=device,
+            indices=possible_tokens,
+            disable_tqdm=disable_tqdm,
+            screening_model=screening_model,
+            screening_fraction=screening_fraction,
+            discarded_mass=discarded_mass
+        )
+
+        full_logits = [logits,] + full_logits
+        p = sample_with_temp(
+            logits,
+            temperature
+        )
+        splus = torch.cat((p.unsqueeze(1), splus), dim=-1)
+        splus_mask = torch.cat((torch.ones_like(p).unsqueeze(1), splus_mask), dim=-1)
+        checkpoint.update(i + 1, full_logits, splus=splus, splus_mask=splus_mask)
+        
+    checkpoint.finish()
+    tokens = [row[:length] for row, length in zip(splus, splus_mask.sum(dim=-1).tolist())]
+    return tokens, torch.stack(full_logits, dim=1)
+
+
+def sample_reverse_dynamics_reverse_prior_batch(
+    model,
+    reverse_model,
+    prefix_length,
+    tokenized_suffixes,
+    vocab_batch_size=1024,
+    temperature=1.0,
+    dilution=0.0,
+    device=None,
+    num_top_tokens=None,
+    disable_tqdm=True,
+    checkpoint_path=None,
+    checkpoint_every=1,
+    checkpoint_group=None,
+    screening_model=None,
+    screening_fraction=0.1,
+    discarded_mass=None
+):
+    # Batched sample_reverse_dynamics_reverse_prior over a list of 1d suffix tensors
+    if device is None:
+        device = model.device
+    splus, splus_mask = pad_suffixes([suffix.to(device) for suffix in tokenized_suffixes])
+    full_logits = []
+    
+    key = torch.stack((splus, splus_mask)).cpu()
+    checkpoint = SamplerCheckpoint(checkpoint_path, key, prefix_length, checkpoint_every, checkpoint_group)
+    start, full_logits, tensors = checkpoint.resume(full_logits, device, splus=splus, splus_mask=splus_mask)
+    splus, splus_mask = tensors["splus"], tensors["splus_mask"]
+    
+    for i in range(start, prefix_length):
+
+        prior_dist, possible_tokens = get_reverse_model_probs_batch(reverse_model, splus, splus_mask, num_top_tokens=num_top_tokens)
+        
+        prior_dist = dilute_prior(prior_dist, dilution, dim=-1)
+        
+        logits = compute_posterior_batch(
+            model=model,
+            stationary_dist=prior_dist,
+            tokenized_suffixes=splus,
+            suffix_mask=splus_mask,
+            vocab_batch_size=vocab_batch_size,
+            device=device,
+            indices=possible_tokens,
+            disable_tqdm=disable_tqdm,
+            screening_model=screening_model,
+            screening_fraction=screening_fraction,
+            discarded_mass=discarded_mass
+        )
+        full_logits = [logits,] + full_logits
+        p = sample_with_temp(
+            logits,
+            temperature
+        )
+        splus = torch.cat((p.unsqueeze(1), splus), dim=-1)
+        splus_mask = torch.cat((torch.ones_like(p).unsqueeze(1), splus_mask), dim=-1)
+        checkpoint.update(i + 1, full_logits, splus=splus, splus_mask=splus_mask)
+        
+    checkpoint.finish()
+    tokens = [row[:length] for row, length in zip(splus, splus_mask.sum(dim=-1).tolist())]
+    return tokens, torch.stack(full_logits, dim=1)
+
+
 def compute_loss_reverse_dynamics(
     model,
     stationary_dist,
     tokenized_suffix,
     vocab_batch_size=1024,
     dilution=0.0,  # 0.3
-    device="cuda",
-    loss = torch.nn.CrossEntropyLoss()
+    device=None,
+    loss = torch.nn.CrossEntropyLoss(),
+    batch_tails=True
 ):
+    if device is None:
+        device = model.device
     full_logits = []
     stationary_dist = stationary_dist.to(device)
     suffix_length = tokenized_suffix.shape[1]
@@ -329,9 +905,22 @@ def compute_loss_reverse_dynamics(
     else:
         raise Exception("Tensor of priors is not the correct shape.")
     
-    uniform_dist = torch.ones_like(stationary_dist) / stationary_dist.shape[0]
-    stationary_dist = stationary_dist * (1-dilution) + uniform_dist * dilution
+    stationary_dist = dilute_prior(stationary_dist, dilution)
     
+    if batch_tails:
+        # Treat every tail tokenized_suffix[:, i:] as a suffix of its own and score all (candidate, tail)
+        # pairs in shared padded batches; row i-1 of the result is the posterior for tail i
+        tails, tail_mask = pad_suffixes([tokenized_suffix[0, i:] for i in range(1, suffix_length)])
+        logits = compute_posterior_batch(
+            model,
+            stationary_dist.T if multiple_priors else stationary_dist,
+            tails,
+            tail_mask,
+            vocab_batch_size,
+            device
+        ).to(tokenized_suffix.device)
+        return loss(logits, tokenized_suffix[0, :-1]).item()
+
     for i in reversed(range(1, tokenized_suffix.shape[1])):
         splus = tokenized_suffix[:, i:] 
 
@@ -359,19 +948,39 @@ def compute_loss_reverse_dynamics_reverse_prior(
     tokenized_suffix,
     vocab_batch_size=1024,
     dilution=0.0,  # 0.3
-    device="cuda",
+    device=None,
     loss = torch.nn.CrossEntropyLoss(),
-    disable_tqdm = False
+    disable_tqdm = False,
+    batch_tails=True
 ):
+    if device is None:
+        device = model.device
     full_logits = []
     
+    if batch_tails:
+        # Reverse-model priors and posteriors for all tails tokenized_suffix[:, i:] in shared padded batches
+        tails, tail_mask = pad_suffixes([tokenized_suffix[0, i:].to(device) for i in range(1, tokenized_suffix.shape[1])])
+        prior_dist, _ = get_reverse_model_probs_batch(reverse_model, tails, tail_mask)
+        
+        prior_dist = dilute_prior(prior_dist, dilution, dim=-1)
+        
+        logits = compute_posterior_batch(
+            model,
+            prior_dist,
+            tails,
+            tail_mask,
+            vocab_batch_size,
+            device,
+            disable_tqdm=disable_tqdm
+        ).to(tokenized_suffix.device)
+        return loss(logits, tokenized_suffix[0, :-1]).item()
+
     for i in tqdm(reversed(range(1, tokenized_suffix.shape[1])),disable=disable_tqdm):
         splus = tokenized_suffix[:, i:]
 
         prior_dist, _ = get_reverse_model_probs(reverse_model, splus)
         
-        uniform_dist = torch.ones_like(prior_dist) / prior_dist.shape[0]
-        prior_dist = prior_dist * (1-dilution) + uniform_dist * dilution
+        prior_dist = dilute_prior(prior_dist, dilution)
         
         logits = compute_posterior(
             model,
@@ -379,7 +988,7 @@ def compute_loss_reverse_dynamics_reverse_prior(
             splus,
             vocab_batch_size,
             device,
-            disable=disable_tqdm
+            disable_tqdm=disable_tqdm
         )
         full_logits = [logits,] + full_logits
             
@@ -394,19 +1003,20 @@ def compute_loss_reverse_dynamics_reverse_prior_target_memory(
     tokenized_suffix,
     target_memory = 10.0, # in gigabytes 
     dilution=0.0,  # 0.3
-    device="cuda",
+    device=None,
     loss = torch.nn.CrossEntropyLoss(),
     disable_tqdm=True
 ):
+    if device is None:
+        device = model.device
     full_logits = []
     
     for i in tqdm(reversed(range(1, tokenized_suffix.shape[1])), disable=disable_tqdm):
         splus = tokenized_suffix[:, i:]
 
-        prior_dist = get_reverse_model_probs(reverse_model, splus)
+        prior_dist, _ = get_reverse_model_probs(reverse_model, splus)
         
-        uniform_dist = torch.ones_like(prior_dist) / prior_dist.shape[0]
-        prior_dist = prior_dist * (1-dilution) + uniform_dist * dilution
+        prior_dist = dilute_prior(prior_dist, dilution)
         
         logits = compute_posterior(
             model,
@@ -414,7 +1024,7 @@ def compute_loss_reverse_dynamics_reverse_prior_target_memory(
             splus,
             math.ceil(target_memory * 1e9/(4*(tokenized_suffix.shape[1]-i)*(50304))),
             device,
-            disable=disable_tqdm
+            disable_tqdm=disable_tqdm
         )
         full_logits = [logits,] + full_logits
             
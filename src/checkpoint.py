@@ -0,0 +1,138 @@
+import glob
+import os
+import random
+import uuid
+
+import numpy as np
+import torch
+
+
+def get_rng_state():
+    state = {
+        "torch": torch.get_rng_state(),
+        "python": random.getstate(),
+        "numpy": np.random.get_state(),
+    }
+    if torch.cuda.is_available():
+        state["cuda"] = torch.cuda.get_rng_state_all()
+    return state
+
+
+def set_rng_state(state):
+    torch.set_rng_state(state["torch"])
+    random.setstate(state["python"])
+    np.random.set_state(state["numpy"])
+    if "cuda" in state and torch.cuda.is_available():
+        torch.cuda.set_rng_state_all(state["cuda"])
+
+
+def temporary_path(path):
+    # Unique name next to path to write to before renaming, so concurrent writers never share a file
+    return f"{path}.{os.getpid()}.{uuid.uuid4().hex}.tmp"
+
+
+def save_checkpoint(path, state):
+    # Written to a temporary file and renamed, so a job killed mid-save keeps its previous checkpoint
+    directory = os.path.dirname(path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    temporary = temporary_path(path)
+    torch.save(state, temporary)
+    os.replace(temporary, path)
+
+
+def load_checkpoint(path, key=None):
+    """
+    State saved at path, or None when there is none or it belongs to another job, i.e. its
+    "key" entry differs from key. Tensors are loaded on the CPU.
+    """
+    if path is None or not os.path.exists(path):
+        return None
+    state = torch.load(path, map_location="cpu", weights_only=False)
+    if key is not None and not same_key(state.get("key"), key):
+        return None
+    return state
+
+
+def same_key(saved, key):
+    if isinstance(key, torch.Tensor) and isinstance(saved, torch.Tensor):
+        return torch.equal(saved, key.cpu())
+    return saved == key
+
+
+def remove_checkpoint(path):
+    # Also removes the per-step logits files of save_sampler_state
+    if path is None:
+        return
+    for name in [path] + glob.glob(glob.escape(path) + ".logits-*.pt"):
+        if os.path.exists(name):
+            os.remove(name)
+
+
+def logits_path(path, group, step):
+    return f"{path}.logits-{group}-{step}.pt"
+
+
+def load_sampler_state(path, key, group=None):
+    """
+    State saved by save_sampler_state for the same group and key, None when there is none. The RNG
+    state is restored and "full_logits" rebuilt from the per-step files, newest step first.
+    """
+    checkpoint = load_checkpoint(path)
+    state = None if checkpoint is None else checkpoint.get(group)
+    if state is None or not same_key(state["key"], key):
+        return None
+    set_rng_state(state["rng"])
+    state["full_logits"] = [torch.load(logits_path(path, group, step), map_location="cpu") for step in reversed(range(state["step"]))]
+    return state
+
+
+def save_sampler_state(path, key, step, full_logits, saved_step=0, group=None, **tensors):
+    """
+    Checkpoint of a token-by-token sampler after step steps, full_logits newest step first. Each step's
+    logits go to a file of their own and only steps from saved_step on are written, so a save does
+    not rewrite earlier steps. The samplers of one call, e.g. the prefix-length groups of
+    optimize_batch, share path under different groups. Returns the new saved_step.
+    """
+    for s in range(saved_step, step):
+        save_checkpoint(logits_path(path, group, s), full_logits[step - 1 - s].cpu())
+    checkpoint = load_checkpoint(path) or {}
+    checkpoint[group] = {"key": key.cpu(), "step": step, "rng": get_rng_state()}
+    checkpoint[group].update({name: tensor.cpu() for name, tensor in tensors.items()})
+    save_checkpoint(path, checkpoint)
+    return step
+
+
+class SamplerCheckpoint:
+    """
+    Checkpoint of a token-by-token sampler of num_steps steps, saved with save_sampler_state every
+    `every` steps, a None path disables it. The last step of a group is saved too, so that a restarted
+    optimize_batch skips finished groups, and group checkpoints are left for the caller to remove.
+    """
+
+    def __init__(self, path, key, num_steps, every=1, group=None):
+        self.path = path
+        self.key = key
+        self.num_steps = num_steps
+        self.every = every
+        self.group = group
+        self.saved_step = 0
+
+    def resume(self, full_logits, device=None, **tensors):
+        # (first step, full_logits, tensors) of a checkpoint of the same key, the given ones when there is none
+        state = load_sampler_state(self.path, self.key, self.group)
+        if state is None:
+            return 0, full_logits, tensors
+        self.saved_step = state["step"]
+        tensors = {name: state[name].to(tensor.device) for name, tensor in tensors.items()}
+        return state["step"], [logits.to(device) for logits in state["full_logits"]], tensors
+
+    def update(self, step, full_logits, **tensors):
+        if self.path is None:
+            return
+        if step % self.every == 0 or (self.group is not None and step == self.num_steps):
+            self.saved_step = save_sampler_state(self.path, self.key, step, full_logits, self.saved_step, self.group, **tensors)
+
+    def finish(self):
+        if self.group is None:
+            remove_checkpoint(self.path)
@@ -1,4 +1,6 @@
-import numpy as np
+import copy
+import time
+
 import torch
 import torch.nn as nn
 from transformers import (AutoModelForCausalLM, AutoTokenizer)
@@ -7,16 +9,24 @@ from transformers.generation.logits_process import (LogitsProcessor,
 from datasets import load_dataset
 from typing import Callable, Iterable, Any
 import matplotlib.pyplot as plt
+from src.checkpoint import get_rng_state, load_checkpoint, remove_checkpoint, save_checkpoint, set_rng_state
+from src.instrumentation import count_backward, count_forward, phase
+from src.runtime import inference_context
+from src.token_filters import get_token_mask
+from src.utils import forward_loss_tokens, gather_logprobs, is_out_of_memory, memory_budget, rand_init_tokens, select_past_key_values
 
 
 SOFTMAX_FINAL = nn.Softmax(dim=-1)
 LOGSOFTMAX_FINAL = nn.LogSoftmax(dim=-1)
 CROSSENT = nn.CrossEntropyLoss(reduction='none')
 
+# Proposal micro-batch sizes that fit in memory, keyed by (model, sequence length)
+PROPOSAL_BATCH_SIZES = {}
+
 
 def token_gradients(model, input_ids, input_slice, target_slice, loss_slice):
     """
-    Copied from (https://github.com/llm-attacks/llm-attacks/blob/main/llm_attacks/gcg/gcg_attack.py)
+    Adapted from (https://github.com/llm-attacks/llm-attacks/blob/main/llm_attacks/gcg/gcg_attack.py)
 
     Computes gradients of the loss with respect to the coordinates.
 
@@ -25,7 +35,7 @@ def token_gradients(model, input_ids, input_slice, target_slice, loss_slice):
     model : Transformer Model
         The transformer model to be used.
     input_ids : torch.Tensor
-        The input sequence in the form of token ids.
+        The input sequence in the form of token ids, [L] or a batch [B, L] of equally long sequences.
     input_slice : slice
         The slice of the input sequence for which gradients need to be computed.
     target_slice : slice
@@ -36,28 +46,18 @@ def token_gradients(model, input_ids, input_slice, target_slice, loss_slice):
     Returns
     -------
     torch.Tensor
-        The gradients of each token in the input_slice with respect to the loss.
+        The gradients of each token in the input_slice with respect to the loss, [input_len, vocab]
+        or [B, input_len, vocab] for batched input_ids.
     """
 
-    embed_weights = list(model.modules())[2]
-    assert type(embed_weights).__name__=='Embedding'
-    embed_weights = embed_weights.weight
-    one_hot = torch.zeros(
-        input_ids[input_slice].shape[0],
-        embed_weights.shape[0],
-        device=model.device,
-        dtype=embed_weights.dtype
-    )
-    one_hot.scatter_(
-        1,
-        input_ids[input_slice].unsqueeze(1),
-        torch.ones(one_hot.shape[0], 1, device=model.device, dtype=embed_weights.dtype)
-    )
-    one_hot.requires_grad_()
-    input_embeds = (one_hot @ embed_weights).unsqueeze(0)
-
-    # now stitch it together with the rest of the embeddings
-    embeds = model.get_input_embeddings()(input_ids.unsqueeze(0)).detach()
+    squeeze = input_ids.dim() == 1
+    if squeeze:
+        input_ids = input_ids.unsqueeze(0)
+    # The gradient w.r.t. a one-hot encoding is the gradient w.r.t. its embedding projected onto the embedding
+    # table, so differentiate w.r.t. the looked-up embeddings and do the projection once at the end
+    embed_weights = model.get_input_embeddings().weight
+    embeds = model.get_input_embeddings()(input_ids).detach()
+    input_embeds = embeds[:, input_slice, :].clone().requires_grad_()
     full_embeds = torch.cat(
         [
             embeds[:,:input_slice.start,:],
@@ -66,13 +66,16 @@ def token_gradients(model, input_ids, input_slice, target_slice, loss_slice):
         ],
         dim=1)
 
-    logits = model(inputs_embeds=full_embeds).logits
-    targets = input_ids[target_slice]
-    loss = nn.CrossEntropyLoss()(logits[0,loss_slice,:], targets)
+    count_forward(input_ids)
+    hidden = model.base_model(inputs_embeds=full_embeds).last_hidden_state
+    # Rows are summed so every row gets the gradient of its own mean loss
+    loss = -gather_logprobs(model, hidden[:, loss_slice, :], input_ids[:, target_slice]).mean(dim=1).sum()
 
-    loss.backward()
+    grad, = torch.autograd.grad(loss, input_embeds)
+    count_backward()
 
-    return one_hot.grad.clone()
+    grad = grad @ embed_weights.T
+    return grad[0] if squeeze else grad
 
 
 def get_nonascii_toks(tokenizer, device='cpu'):
@@ -120,7 +123,18 @@ class GreedyCoordinateGradient:
         prefix_loss_weight: float = 0.0,
         temperature: int = 0,
         revert_on_loss_increase: bool = False,
-        ascii_only: bool = True
+        ascii_only: bool = True,
+        token_filter: str = "ascii",
+        share_prefix_cache: bool = True,
+        proposal_batch_size: int = None,
+        n_restarts: int = 1,
+        patience: int = None,
+        min_delta: float = 0.0,
+        target_loss: float = None,
+        time_budget: float = None,
+        stop_on_greedy_match: bool = False,
+        checkpoint_path: str = None,
+        checkpoint_every: int = 10
     ):
 
         self.model = model
@@ -132,7 +146,27 @@ class GreedyCoordinateGradient:
         self.temperature = temperature
         self.revert_on_loss_increase = revert_on_loss_increase
         self.ascii_only = ascii_only
-        self.non_ascii_tokens = get_nonascii_toks(tokenizer)
+        self.share_prefix_cache = share_prefix_cache
+        self.proposal_batch_size = proposal_batch_size
+        self.n_restarts = n_restarts
+        # Early stopping: epochs without an improvement of the best loss by more than min_delta, a loss
+        # low enough, seconds per optimize call, or the target being the greedy continuation of the prefix
+        self.patience = patience
+        self.min_delta = min_delta
+        self.target_loss = target_loss
+        self.time_budget = time_budget
+        self.stop_on_greedy_match = stop_on_greedy_match
+        # Per-epoch losses of the last optimize call, one list of restart traces per target
+        self.history = []
+        # The state of an interrupted call is saved every checkpoint_every epochs, a call on the same
+        # targets resumes from it and the file is removed once the call returns
+        self.checkpoint_path = checkpoint_path
+        self.checkpoint_every = checkpoint_every
+        self.checkpoint = {}
+        self.token_filter = token_filter if ascii_only else None
+        # Excluded tokens come from a mask cached on disk per vocabulary, decoding the vocabulary takes seconds
+        if self.token_filter is not None:
+            self.non_ascii_tokens = torch.nonzero(~get_token_mask(tokenizer, self.token_filter)).squeeze(1)
 
     def calculate_restricted_subset(
         self,
@@ -142,11 +176,11 @@ class GreedyCoordinateGradient:
         loss_slice
     ):
         # Find the subset of tokens that have the most impact on the likelihood of the target
-        grad = token_gradients(self.model, input_ids, input_slice, target_slice, loss_slice)
-        if self.ascii_only:
-            grad[:, self.non_ascii_tokens] = grad.max() + 1
+        with phase("gcg.gradients"):
+            grad = token_gradients(self.model, input_ids, input_slice, target_slice, loss_slice)
+        if self.token_filter is not None:
+            grad[..., self.non_ascii_tokens] = grad.max() + 1
         top_indices = torch.topk(-grad, self.n_top_indices, dim=-1).indices
-        top_indices = top_indices.detach().cpu().numpy()
         return top_indices
 
     def sample_proposals(
@@ -157,22 +191,108 @@ class GreedyCoordinateGradient:
         target_slice,
         loss_slice,
     ):
-        # Sample random proposals
-        proposals = []
-        if self.temperature:
-            logits = self.model(input_ids.view(1, *input_ids.shape)).logits
-            probs = SOFTMAX_FINAL(logits/self.temperature)
-        for p in range(self.n_proposals):
+        # input_ids is [L] or a batch [N, L] with top_indices [N, input_len, k], proposals are [N * n_proposals, L]
+        with phase("gcg.sampling"):
+            if input_ids.dim() == 1:
+                input_ids, top_indices = input_ids.unsqueeze(0), top_indices.unsqueeze(0)
+            num_rows = input_ids.shape[0]
+            # Sample one (position, token) swap per proposal and apply all of them with a single scatter
+            positions = torch.randint(input_slice.start, input_slice.stop, (num_rows, self.n_proposals), device=input_ids.device)
+            rows = torch.arange(num_rows, device=input_ids.device).unsqueeze(1)
             if self.temperature:
-                token_pos = np.random.randint(input_slice.start, input_slice.stop)
-                rand_token = torch.multinomial(probs[0, token_pos, :], 1).item()
+                with inference_context():
+                    count_forward(input_ids)
+                    logits = self.model(input_ids).logits.float()
+                probs = SOFTMAX_FINAL(logits/self.temperature)
+                rand_tokens = torch.multinomial(probs[rows, positions, :].view(-1, probs.shape[-1]), 1).view(num_rows, -1)
             else:
-                token_pos = np.random.randint(input_slice.start, input_slice.stop)
-                rand_token = np.random.choice(top_indices[token_pos])
-            prop = input_ids.clone()
-            prop[token_pos] = rand_token
-            proposals.append(prop)
-        return torch.stack(proposals)
+                choices = torch.randint(0, top_indices.shape[-1], (num_rows, self.n_proposals), device=input_ids.device)
+                rand_tokens = top_indices[rows, positions - input_slice.start, choices]
+            proposals = input_ids.unsqueeze(1).repeat(1, self.n_proposals, 1)
+            proposals.scatter_(2, positions.unsqueeze(2), rand_tokens.unsqueeze(2))
+            return proposals.view(-1, input_ids.shape[-1])
+
+    def get_proposal_batch_size(self, seq_len):
+        if self.proposal_batch_size is not None:
+            return self.proposal_batch_size
+        key = (id(self.model), seq_len)
+        if key not in PROPOSAL_BATCH_SIZES:
+            # Rough per-proposal footprint: sliced logits and their softmax plus per-position activations
+            config = self.model.config
+            bytes_per_proposal = 4 * seq_len * (2 * config.vocab_size + 16 * config.hidden_size)
+            batch_size = memory_budget(self.model.device) // (2 * bytes_per_proposal)
+            PROPOSAL_BATCH_SIZES[key] = int(min(max(batch_size, 1), self.n_proposals))
+        return PROPOSAL_BATCH_SIZES[key]
+
+    def hidden_losses(
+        self,
+        hidden,
+        proposals,
+        input_slice,
+        target_slice,
+        loss_slice,
+    ):
+        # Only the positions that enter the loss are projected onto the vocabulary
+        losses = -gather_logprobs(self.model, hidden[:, loss_slice, :], proposals[:, target_slice]).mean(dim=1)
+        # Add a penalty for unlikely prompts that are not very high-likelihood
+        if self.prefix_loss_weight > 0:
+            shifted1 = slice(input_slice.start, input_slice.stop - 1)
+            shifted2 = slice(input_slice.start + 1, input_slice.stop)
+            prefix_losses = -gather_logprobs(self.model, hidden[:, shifted1, :], proposals[:, shifted2]).mean(dim=1)
+            losses = losses + self.prefix_loss_weight * prefix_losses
+        return losses
+
+    def proposal_losses(
+        self,
+        input_ids,
+        proposals,
+        input_slice,
+        target_slice,
+        loss_slice,
+    ):
+        # input_ids is [L] or a batch [N, L], in which case proposals hold n_proposals rows per input in order
+        with phase("gcg.proposal_scoring"):
+            if input_ids.dim() == 1:
+                input_ids = input_ids.unsqueeze(0)
+            parents = torch.arange(input_ids.shape[0], device=proposals.device).repeat_interleave(proposals.shape[0] // input_ids.shape[0])
+            seq_len = input_ids.shape[1]
+            base_model = self.model.base_model
+            if self.share_prefix_cache:
+                # Proposals match their input up to their first swapped position, so encode the inputs once and run
+                # every group of proposals sharing that position only from there on, on top of the cached prefixes
+                count_forward(input_ids)
+                base = base_model(input_ids, use_cache=True)
+                changed = proposals != input_ids[parents]
+                positions = torch.where(changed.any(dim=1), changed.int().argmax(dim=1), seq_len - 1)
+            else:
+                positions = torch.zeros(proposals.shape[0], dtype=torch.long, device=proposals.device)
+            key = (id(self.model), seq_len)
+            batch_size = self.get_proposal_batch_size(seq_len)
+            losses = torch.empty(proposals.shape[0], device=proposals.device)
+            for pos in positions.unique().tolist():
+                rows = torch.nonzero(positions == pos, as_tuple=True)[0]
+                start = 0
+                while start < rows.shape[0]:
+                    chunk = rows[start:start + batch_size]
+                    try:
+                        count_forward(proposals[chunk, pos:])
+                        if pos > 0:
+                            past_key_values = select_past_key_values(base.past_key_values, parents[chunk], pos)
+                            hidden = base_model(proposals[chunk, pos:], past_key_values=past_key_values).last_hidden_state
+                            hidden = torch.cat((base.last_hidden_state[parents[chunk], :pos], hidden), dim=1)
+                        else:
+                            hidden = base_model(proposals[chunk]).last_hidden_state
+                        losses[chunk] = self.hidden_losses(hidden, proposals[chunk], input_slice, target_slice, loss_slice)
+                    except RuntimeError as error:
+                        # Halve the micro-batch on OOM and remember it for this model and sequence length
+                        if batch_size == 1 or not is_out_of_memory(error):
+                            raise
+                        batch_size = batch_size // 2
+                        if self.proposal_batch_size is None:
+                            PROPOSAL_BATCH_SIZES[key] = batch_size
+                        continue
+                    start += chunk.shape[0]
+            return losses
 
     def optimize(
         self,
@@ -180,37 +300,183 @@ class GreedyCoordinateGradient:
         target_string,
     ):
         # Parse input strings into tokens
-        initial_inputs = self.tokenizer.encode(initial_input, return_tensors="pt")[0].cuda()
-        initial_targets = self.tokenizer.encode(target_string, return_tensors="pt")[0].cuda()
-        input_ids = torch.cat([initial_inputs, initial_targets], dim=0)
-        input_slice = slice(0, initial_inputs.shape[0])
-        target_slice = slice(initial_inputs.shape[0], input_ids.shape[-1])
-        loss_slice = slice(initial_inputs.shape[0] - 1, input_ids.shape[-1] - 1)
-        # Shifted input slices for prefix loss calculation
-        shifted1 = slice(0, initial_inputs.shape[0] - 1)
-        shifted2 = slice(1, initial_inputs.shape[0])
-        # Optimize input
-        prev_loss = None
-        for i in range(self.n_epochs):
+        initial_inputs = self.tokenizer.encode(initial_input, return_tensors="pt")[0]
+        initial_targets = self.tokenizer.encode(target_string, return_tensors="pt")[0]
+        prefix_ids, _, _ = self.optimize_tokens(initial_inputs, initial_targets)
+        return self.tokenizer.decode(torch.cat((prefix_ids, initial_targets.to(prefix_ids.device))))
+
+    def optimize_tokens(
+        self,
+        prefix_ids,
+        target_ids,
+    ):
+        # Token-level entry point, returns the optimized prefix ids with their prefix and suffix losses
+        return self.optimize_batch_tokens([prefix_ids], [target_ids])[0]
+
+    def optimize_batch(
+        self,
+        initial_inputs,
+        target_strings,
+    ):
+        initial_inputs = [self.tokenizer.encode(initial_input, return_tensors="pt")[0] for initial_input in initial_inputs]
+        targets = [self.tokenizer.encode(target, return_tensors="pt")[0] for target in target_strings]
+        outputs = self.optimize_batch_tokens(initial_inputs, targets)
+        return [
+            self.tokenizer.decode(torch.cat((prefix_ids, target.to(prefix_ids.device))))
+            for (prefix_ids, _, _), target in zip(outputs, targets)
+        ]
+
+    def optimize_batch_tokens(
+        self,
+        prefix_ids,
+        target_ids,
+    ):
+        # Optimizes n_restarts prefixes per target, the given prefix and random ones, and returns the best per target.
+        # Targets whose prefix and target have the same number of tokens are optimized in lockstep as one batch
+        lengths = [(len(prefix), len(target)) for prefix, target in zip(prefix_ids, target_ids)]
+        outputs = [None] * len(target_ids)
+        self.history = [None] * len(target_ids)
+        start_time = time.perf_counter()
+        # One state per group of equally long inputs, keyed by (prefix length, target length)
+        self.checkpoint = load_checkpoint(self.checkpoint_path) or {}
+        for prefix_len, target_len in sorted(set(lengths)):
+            group = [j for j, l in enumerate(lengths) if l == (prefix_len, target_len)]
+            input_ids = torch.stack([
+                torch.cat((prefix_ids[j] if r == 0 else rand_init_tokens(prefix_len, self.tokenizer), target_ids[j].cpu()))
+                for j in group for r in range(self.n_restarts)
+            ]).to(self.model.device)
+            input_slice = slice(0, prefix_len)
+            target_slice = slice(prefix_len, prefix_len + target_len)
+            loss_slice = slice(prefix_len - 1, prefix_len + target_len - 1)
+            input_ids, history = self.optimize_rows(
+                input_ids, input_slice, target_slice, loss_slice, start_time, checkpoint_key=(prefix_len, target_len)
+            )
+            prefix_losses, suffix_losses = forward_loss_tokens(self.model, input_ids[:, input_slice], input_ids[:, target_slice])
+            # Pick the restart with the best value of the objective GCG minimizes
+            objective = (suffix_losses + self.prefix_loss_weight * prefix_losses).view(len(group), self.n_restarts)
+            best = objective.argmin(dim=1) + torch.arange(len(group), device=objective.device) * self.n_restarts
+            for i, (j, row) in enumerate(zip(group, best.tolist())):
+                outputs[j] = (input_ids[row, input_slice], prefix_losses[row], suffix_losses[row])
+                self.history[j] = history[i * self.n_restarts:(i + 1) * self.n_restarts]
+        remove_checkpoint(self.checkpoint_path)
+        return outputs
+
+    def save_rows_checkpoint(self, key, state):
+        # Copies, the live tensors keep being updated in place
+        state = {k: v.clone().cpu() if isinstance(v, torch.Tensor) else copy.deepcopy(v) for k, v in state.items()}
+        state["rng"] = get_rng_state()
+        self.checkpoint[key] = state
+        save_checkpoint(self.checkpoint_path, self.checkpoint)
+
+    def greedy_matches(
+        self,
+        input_ids,
+        target_slice,
+        loss_slice,
+    ):
+        # Whether greedy decoding from each row's prefix reproduces its target
+        count_forward(input_ids)
+        hidden = self.model.base_model(input_ids).last_hidden_state[:, loss_slice]
+        predictions = self.model.get_output_embeddings()(hidden).argmax(dim=-1)
+        return (predictions == input_ids[:, target_slice]).all(dim=1)
+
+    def optimize_rows(
+        self,
+        input_ids,
+        input_slice,
+        target_slice,
+        loss_slice,
+        start_time=None,
+        checkpoint_key=None,
+    ):
+        # Runs GCG on every row of the [N, L] input_ids at once, rows share the slices but nothing else. Returns the
+        # best rows seen and a trace per row; rows that met a stopping criterion drop out of the batch
+        if start_time is None:
+            start_time = time.perf_counter()
+        num_rows = input_ids.shape[0]
+        prev_loss = torch.full((num_rows,), float("inf"), device=input_ids.device)
+        best_ids = input_ids.clone()
+        best_loss = prev_loss.clone()
+        stale = torch.zeros(num_rows, dtype=torch.long, device=input_ids.device)
+        history = [{"loss": [], "best_loss": None, "epochs": 0, "stop_reason": "n_epochs"} for _ in range(num_rows)]
+        active = torch.arange(num_rows, device=input_ids.device)
+        first_epoch = 0
+        checkpointing = self.checkpoint_path is not None and checkpoint_key is not None
+        state = self.checkpoint.get(checkpoint_key) if checkpointing else None
+        if state is not None and torch.equal(state["targets"], input_ids[:, target_slice].cpu()):
+            # Continue exactly where the interrupted call stopped, including its random number streams
+            set_rng_state(state["rng"])
+            input_ids, best_ids, best_loss, prev_loss, stale, active = [
+                state[k].to(input_ids.device) for k in ["input_ids", "best_ids", "best_loss", "prev_loss", "stale", "active"]
+            ]
+            history = state["history"]
+            first_epoch = state["epoch"]
+            if state["done"]:
+                return best_ids, history
+        targets = input_ids[:, target_slice]
+
+        def rows_state(epoch, done):
+            return {
+                "targets": targets, "input_ids": input_ids, "best_ids": best_ids, "best_loss": best_loss,
+                "prev_loss": prev_loss, "stale": stale, "active": active, "history": history, "epoch": epoch, "done": done
+            }
+
+        for i in range(first_epoch, self.n_epochs):
+            if self.time_budget is not None and time.perf_counter() - start_time > self.time_budget:
+                for row in active.tolist():
+                    history[row]["stop_reason"] = "time_budget"
+                break
+            current = input_ids[active]
+            rows = torch.arange(active.shape[0], device=input_ids.device)
             # Get proposals for next string
-            top_indices = self.calculate_restricted_subset(input_ids, input_slice, target_slice, loss_slice)
-            proposals = self.sample_proposals(input_ids, top_indices, input_slice, target_slice, loss_slice)
+            top_indices = self.calculate_restricted_subset(current, input_slice, target_slice, loss_slice)
+            proposals = self.sample_proposals(current, top_indices, input_slice, target_slice, loss_slice)
             # Choose the proposal with the lowest loss
-            with torch.no_grad():
-                prop_logits = self.model(proposals).logits
-                targets = input_ids[target_slice]
-                losses = [nn.CrossEntropyLoss()(prop_logits[pidx, loss_slice, :], targets).item() for pidx in range(prop_logits.shape[0])]
-                # Add a penalty for unlikely prompts that are not very high-likelihood
-                if self.prefix_loss_weight > 0:
-                    shifted_inputs = input_ids[shifted2]
-                    prefix_losses = [nn.CrossEntropyLoss()(prop_logits[pidx, shifted1, :], shifted_inputs).item() for pidx in range(prop_logits.shape[0])]
-                    losses = [losses[i] + self.prefix_loss_weight * prefix_losses[i] for i in range(len(losses))]
+            with inference_context():
+                losses = self.proposal_losses(current, proposals, input_slice, target_slice, loss_slice)
                 # Choose next prompt
-                new_loss = min(losses)
-                min_idx = np.array(losses).argmin()
-                #print(new_loss)
-                if prev_loss is None or new_loss < prev_loss or not self.revert_on_loss_increase:
-                    input_ids = proposals[min_idx]
-                    prev_loss = new_loss
-        return self.tokenizer.decode(input_ids)
+                new_loss, min_idx = losses.view(active.shape[0], -1).min(dim=1)
+            #print(new_loss)
+            accept = new_loss < prev_loss[active]
+            if not self.revert_on_loss_increase:
+                accept = torch.ones_like(accept)
+            best = proposals.view(active.shape[0], -1, input_ids.shape[1])[rows, min_idx]
+            input_ids[active] = torch.where(accept.unsqueeze(1), best, current)
+            prev_loss[active] = torch.where(accept, new_loss, prev_loss[active])
+            # Keep the best sequence seen, the current one may be worse when losses are allowed to increase
+            improved = new_loss < best_loss[active] - self.min_delta
+            better = new_loss < best_loss[active]
+            best_ids[active[better]] = best[better]
+            best_loss[active] = torch.minimum(best_loss[active], new_loss)
+            stale[active] = torch.where(improved, 0, stale[active] + 1)
 
+            done = torch.zeros_like(accept)
+            reasons = [None] * active.shape[0]
+            checks = []
+            if self.target_loss is not None:
+                checks.append(("target_loss", best_loss[active] <= self.target_loss))
+            if self.patience is not None:
+                checks.append(("patience", stale[active] >= self.patience))
+            if self.stop_on_greedy_match:
+                with inference_context():
+                    matches = self.greedy_matches(best_ids[active], target_slice, loss_slice)
+                checks.append(("greedy_match", matches))
+            for name, stop in checks:
+                for k in torch.nonzero(stop & ~done).squeeze(1).tolist():
+                    reasons[k] = name
+                done |= stop
+            for k, (row, loss) in enumerate(zip(active.tolist(), prev_loss[active].tolist())):
+                history[row]["loss"].append(loss)
+                history[row]["epochs"] = i + 1
+                if reasons[k] is not None:
+                    history[row]["stop_reason"] = reasons[k]
+            active = active[~done]
+            if active.shape[0] == 0:
+                break
+            if checkpointing and (i + 1) % self.checkpoint_every == 0:
+                self.save_rows_checkpoint(checkpoint_key, rows_state(i + 1, False))
+        for row, loss in enumerate(best_loss.tolist()):
+            history[row]["best_loss"] = loss
+        if checkpointing:
+            self.save_rows_checkpoint(checkpoint_key, rows_state(self.n_epochs, True))
+        return best_ids, history
@@ -0,0 +1,184 @@
+import contextlib
+import json
+import math
+import resource
+import sys
+import time
+
+import torch
+
+
+NULL_CONTEXT = contextlib.nullcontext()
+
+# The recorder of the optimizer call being instrumented, None when instrumentation is off
+ACTIVE = None
+
+
+class Recorder:
+    """
+    Per-call statistics: forward/backward passes, tokens processed and batch shapes for each
+    phase, time spent per phase, the peak memory of the call and any other reported metrics.
+    """
+
+    def __init__(self, name=None):
+        self.name = name
+        self.phases = {}
+        self.stack = []
+        self.wall_time = 0.0
+        self.peak_memory_mb = None
+        self.memory_device = None
+        # Peak resident set size of nested calls, which reset the kernel's high-water mark
+        self.nested_peak_kb = 0
+        self.metrics = {}
+
+    def get_phase(self, name):
+        if name not in self.phases:
+            self.phases[name] = {
+                "time": 0.0,
+                "calls": 0,
+                "forward_passes": 0,
+                "backward_passes": 0,
+                "tokens": 0,
+                "batch_shapes": {},
+            }
+        return self.phases[name]
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        stats = self.get_phase(name)
+        self.stack.append(name)
+        t1 = time.perf_counter()
+        try:
+            yield stats
+        finally:
+            stats["time"] += time.perf_counter() - t1
+            stats["calls"] += 1
+            self.stack.pop()
+
+    def current_phase(self):
+        # Passes are attributed to the innermost open phase
+        return self.get_phase(self.stack[-1] if self.stack else "other")
+
+    def count_forward(self, shape):
+        stats = self.current_phase()
+        stats["forward_passes"] += 1
+        stats["tokens"] += math.prod(shape)
+        key = str(list(shape))
+        stats["batch_shapes"][key] = stats["batch_shapes"].get(key, 0) + 1
+
+    def count_backward(self):
+        self.current_phase()["backward_passes"] += 1
+
+    def add_metric(self, name, value):
+        stats = self.metrics.setdefault(name, {"total": 0.0, "count": 0, "max": None})
+        stats["total"] += value
+        stats["count"] += 1
+        stats["max"] = value if stats["max"] is None else max(stats["max"], value)
+
+    def to_dict(self):
+        return {
+            "name": self.name,
+            "wall_time": self.wall_time,
+            "forward_passes": sum(p["forward_passes"] for p in self.phases.values()),
+            "backward_passes": sum(p["backward_passes"] for p in self.phases.values()),
+            "tokens": sum(p["tokens"] for p in self.phases.values()),
+            "peak_memory_mb": self.peak_memory_mb,
+            "memory_device": self.memory_device,
+            "phases": self.phases,
+            "metrics": self.metrics,
+        }
+
+    def to_json(self, path):
+        with open(path, 'w') as f:
+            json.dump(self.to_dict(), f, indent=2)
+
+
+def read_status_kb(field):
+    # Memory field of /proc/self/status in kilobytes, None where /proc is unavailable
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith(field + ":"):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    return None
+
+
+def read_peak_rss_kb():
+    # Linux high-water mark of the resident set size
+    return read_status_kb("VmHWM")
+
+
+def read_rss_kb():
+    return read_status_kb("VmRSS")
+
+
+def reset_peak_rss():
+    # Writing 5 to clear_refs resets VmHWM to the current resident set size (Linux >= 4.0)
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+        return True
+    except OSError:
+        return False
+
+
+@contextlib.contextmanager
+def record(name=None, enabled=True):
+    # Instrument everything run inside the block, yields None when disabled
+    global ACTIVE
+    if not enabled:
+        yield None
+        return
+    recorder = Recorder(name)
+    previous, ACTIVE = ACTIVE, recorder
+    cuda = torch.cuda.is_available()
+    if cuda:
+        torch.cuda.reset_peak_memory_stats()
+    else:
+        outer_peak_kb = read_peak_rss_kb()
+        per_call = outer_peak_kb is not None and reset_peak_rss()
+    t1 = time.perf_counter()
+    try:
+        yield recorder
+    finally:
+        recorder.wall_time = time.perf_counter() - t1
+        if cuda:
+            recorder.peak_memory_mb = torch.cuda.max_memory_allocated() / 1024 ** 2
+            recorder.memory_device = "cuda"
+        elif per_call:
+            # Peak resident set size since the call started
+            peak_kb = max(read_peak_rss_kb(), recorder.nested_peak_kb)
+            recorder.peak_memory_mb = peak_kb / 1024
+            recorder.memory_device = "cpu"
+            if previous is not None:
+                # The reset above hid the enclosing call's peak so far from it
+                previous.nested_peak_kb = max(previous.nested_peak_kb, outer_peak_kb, peak_kb)
+        else:
+            # Peak resident set size of the whole process so far (kilobytes on Linux, bytes on macOS)
+            maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+            recorder.peak_memory_mb = maxrss / (1024 ** 2 if sys.platform == "darwin" else 1024)
+            recorder.memory_device = "cpu-process"
+        ACTIVE = previous
+
+
+def phase(name):
+    if ACTIVE is None:
+        return NULL_CONTEXT
+    return ACTIVE.phase(name)
+
+
+def count_forward(input_ids):
+    if ACTIVE is not None:
+        ACTIVE.count_forward(input_ids.shape)
+
+
+def count_backward():
+    if ACTIVE is not None:
+        ACTIVE.count_backward()
+
+
+def add_metric(name, value):
+    if ACTIVE is not None:
+        ACTIVE.add_metric(name, float(value))
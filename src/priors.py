@@ -0,0 +1,149 @@
+import json
+import os
+import time
+
+import torch
+
+from src.checkpoint import temporary_path
+from src.token_filters import tokenizer_hash
+
+
+# Priors already loaded in this process, keyed by (store path, name, version, smoothing, dilution)
+PRIORS = {}
+
+
+def dilute_prior(prior, dilution=0.0, dim=0):
+    # Mix with the uniform distribution over dim, a zero dilution returns prior itself
+    if not dilution:
+        return prior
+    uniform_dist = torch.ones_like(prior) / prior.shape[dim]
+    return prior * (1-dilution) + uniform_dist * dilution
+
+
+def smooth_prior(prior, smoothing=None, dim=0):
+    # "min" gives zero-probability tokens the smallest nonzero probability, then renormalizes over dim
+    if smoothing is None:
+        return prior
+    if smoothing != "min":
+        raise ValueError(f"Unknown smoothing {smoothing!r}, expected None or 'min'")
+    floor = torch.where(prior > 0, prior, torch.full_like(prior, float("inf"))).amin(dim=dim, keepdim=True)
+    prior = torch.where(prior > 0, prior, floor)
+    return prior / prior.sum(dim=dim, keepdim=True)
+
+
+def variant_name(smoothing=None, dilution=0.0):
+    return f"s-{smoothing or 'none'}_d-{float(dilution):g}"
+
+
+class PriorStore:
+    """
+    Directory of prior distributions with an index.json registry. Every version of a prior records
+    the model and tokenizer hash it belongs to, and keeps precomputed smoothing and dilution variants
+    that are memory-mapped on load, so worker processes share one page-cached copy.
+    """
+
+    def __init__(self, path="data/priors"):
+        self.path = path
+        os.makedirs(path, exist_ok=True)
+
+    @property
+    def index_path(self):
+        return os.path.join(self.path, "index.json")
+
+    def index(self):
+        if not os.path.exists(self.index_path):
+            return {}
+        with open(self.index_path) as f:
+            return json.load(f)
+
+    def write_index(self, index):
+        temporary = temporary_path(self.index_path)
+        with open(temporary, "w") as f:
+            json.dump(index, f, indent=2, sort_keys=True)
+        os.replace(temporary, self.index_path)
+
+    def names(self):
+        return sorted(self.index())
+
+    def versions(self, name):
+        return self.index().get(name, [])
+
+    def metadata(self, name, version=None):
+        versions = self.versions(name)
+        if not versions:
+            raise KeyError(f"No prior named {name!r} in {self.path}")
+        if version is None:
+            return versions[-1]
+        for entry in versions:
+            if entry["version"] == version:
+                return entry
+        raise KeyError(f"Prior {name!r} has no version {version}")
+
+    def add(self, name, dist, model=None, tokenizer=None, source=None, smoothings=(None,), dilutions=(0.0,), dim=0):
+        """
+        Register dist as the next version of name, with one file per (smoothing, dilution) variant.
+        dim is the vocabulary dimension, 0 for [vocab] and [vocab, positions] priors.
+        """
+        index = self.index()
+        versions = index.get(name, [])
+        version = versions[-1]["version"] + 1 if versions else 1
+        dist = dist.detach().cpu().contiguous()
+        entry = {
+            "version": version,
+            "model": model,
+            "tokenizer": tokenizer.name_or_path if tokenizer is not None else None,
+            "tokenizer_hash": tokenizer_hash(tokenizer) if tokenizer is not None else None,
+            "source": source,
+            "shape": list(dist.shape),
+            "dtype": str(dist.dtype).replace("torch.", ""),
+            "vocab_dim": dim,
+            "created": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "variants": {},
+        }
+        for smoothing in smoothings:
+            smoothed = smooth_prior(dist, smoothing, dim)
+            for dilution in dilutions:
+                variant = variant_name(smoothing, dilution)
+                entry["variants"][variant] = self.save_variant(name, version, variant, dilute_prior(smoothed, dilution, dim))
+        index[name] = versions + [entry]
+        self.write_index(index)
+        return entry
+
+    def add_file(self, path, name=None, **kwargs):
+        # Register a distribution saved with torch.save, e.g. data/distributions/pile_empirical.pt
+        if name is None:
+            name = os.path.splitext(os.path.basename(path))[0]
+        return self.add(name, torch.load(path), source=kwargs.pop("source", path), **kwargs)
+
+    def save_variant(self, name, version, variant, dist):
+        filename = f"{name}-v{version}-{variant}.pt"
+        temporary = temporary_path(os.path.join(self.path, filename))
+        torch.save(dist.contiguous(), temporary)
+        os.replace(temporary, os.path.join(self.path, filename))
+        return filename
+
+    def load(self, name, version=None, smoothing=None, dilution=0.0, tokenizer=None, mmap=True):
+        """
+        Prior name, memory-mapped from its precomputed variant. Variants that were not precomputed
+        are derived from the undiluted one in memory. Raises a ValueError when tokenizer does not
+        match the tokenizer the prior was registered with.
+        """
+        entry = self.metadata(name, version)
+        if tokenizer is not None and entry["tokenizer_hash"] is not None and tokenizer_hash(tokenizer) != entry["tokenizer_hash"]:
+            raise ValueError(f"Prior {name!r} v{entry['version']} was built for tokenizer {entry['tokenizer']}, not {tokenizer.name_or_path}")
+        key = (os.path.abspath(self.path), name, entry["version"], smoothing, float(dilution))
+        if key in PRIORS:
+            return PRIORS[key]
+        variant = variant_name(smoothing, dilution)
+        if variant in entry["variants"]:
+            dist = torch.load(os.path.join(self.path, entry["variants"][variant]), mmap=mmap, weights_only=True)
+        else:
+            base = entry["variants"].get(variant_name(smoothing, 0.0))
+            if base is not None:
+                dist = torch.load(os.path.join(self.path, base), mmap=mmap, weights_only=True)
+            else:
+                base = entry["variants"][variant_name(None, 0.0)]
+                dist = smooth_prior(torch.load(os.path.join(self.path, base), mmap=mmap, weights_only=True), smoothing, entry["vocab_dim"])
+            dist = dilute_prior(dist, dilution, entry["vocab_dim"])
+        PRIORS[key] = dist
+        return dist
@@ -0,0 +1,209 @@
+import glob
+import json
+import os
+import pickle
+import uuid
+
+
+# One row per (pair, optimizer), the fields of output_stats[suffix] and output_stats[suffix]["prompt_opts"][optimizer]
+RESULT_COLUMNS = [
+    "run",
+    "pair",
+    "optimizer",
+    "suffix",
+    "gt_prefix",
+    "gt_prefix_loss",
+    "gt_suffix_loss",
+    "prefix",
+    "prefix_loss",
+    "suffix_loss",
+    "time",
+    "parameters",
+    "instrumentation",
+    "trace",
+]
+
+# Stored as json strings, so that runs with different arguments share a schema
+JSON_COLUMNS = ["parameters", "instrumentation", "trace"]
+
+
+def import_pyarrow():
+    try:
+        import pyarrow
+        import pyarrow.dataset
+        import pyarrow.parquet
+    except ImportError as error:
+        raise ImportError("The results store needs pyarrow, install it with `pip install pyarrow`") from error
+    return pyarrow
+
+
+def result_schema():
+    pa = import_pyarrow()
+    return pa.schema([
+        ("run", pa.string()),
+        ("pair", pa.int64()),
+        ("optimizer", pa.string()),
+        ("suffix", pa.string()),
+        ("gt_prefix", pa.string()),
+        ("gt_prefix_loss", pa.float64()),
+        ("gt_suffix_loss", pa.float64()),
+        ("prefix", pa.string()),
+        ("prefix_loss", pa.float64()),
+        ("suffix_loss", pa.float64()),
+        ("time", pa.float64()),
+        # JSON_COLUMNS
+        ("parameters", pa.string()),
+        ("instrumentation", pa.string()),
+        ("trace", pa.string()),
+    ])
+
+
+def to_row(result, run, parameters=None):
+    row = {column: result.get(column) for column in RESULT_COLUMNS}
+    row["run"] = run
+    for column in JSON_COLUMNS:
+        value = parameters if column == "parameters" else row[column]
+        row[column] = None if value is None or isinstance(value, str) else json.dumps(value)
+    return row
+
+
+class ResultStore:
+    """
+    Directory of Parquet part files, one row per (pair, optimizer). Parts are written to a
+    temporary name and renamed, so readers and restarted runs never see a partial file.
+    Parts written before a column was added read it as null.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        os.makedirs(path, exist_ok=True)
+
+    def parts(self):
+        return sorted(glob.glob(os.path.join(self.path, "*.parquet")))
+
+    def append(self, rows):
+        pa = import_pyarrow()
+        if not rows:
+            return None
+        table = pa.Table.from_pylist(rows, schema=result_schema())
+        name = os.path.join(self.path, f"part-{uuid.uuid4().hex}.parquet")
+        with open(name + ".tmp", "wb") as f:
+            pa.parquet.write_table(table, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(name + ".tmp", name)
+        return name
+
+    def dataset(self):
+        pa = import_pyarrow()
+        return pa.dataset.dataset(self.parts(), schema=result_schema(), format="parquet")
+
+    def scan(self, columns=None, filter=None, batch_size=65536):
+        # Stream record batches, only reading the requested columns and the row groups matching filter
+        # e.g. store.scan(["optimizer", "suffix_loss"], filter=pyarrow.dataset.field("run") == name)
+        yield from self.dataset().to_batches(columns=columns, filter=filter, batch_size=batch_size)
+
+    def read(self, columns=None, filter=None):
+        return self.dataset().to_table(columns=columns, filter=filter)
+
+    def to_pandas(self, columns=None, filter=None):
+        return self.read(columns, filter).to_pandas()
+
+    def read_run(self, run, columns=None):
+        pa = import_pyarrow()
+        return self.read(columns, filter=pa.dataset.field("run") == run)
+
+    def completed(self, run):
+        table = self.read_run(run, ["pair", "optimizer"])
+        return set(zip(table.column("pair").to_pylist(), table.column("optimizer").to_pylist()))
+
+    def compact(self):
+        # Merge all parts into one file, the old parts are only removed once the merged one is in place
+        pa = import_pyarrow()
+        parts = self.parts()
+        if len(parts) < 2:
+            return
+        name = os.path.join(self.path, f"part-{uuid.uuid4().hex}.parquet")
+        with pa.parquet.ParquetWriter(name + ".tmp", result_schema()) as writer:
+            for batch in self.dataset().to_batches():
+                writer.write_batch(batch)
+        os.replace(name + ".tmp", name)
+        for part in parts:
+            os.remove(part)
+
+
+def to_output_stats(rows, parameters=None):
+    # Suffix-keyed dict in the layout the elicitation script used to pickle
+    output_stats = {}
+    output_stats["parameters"] = parameters if parameters is not None else {}
+    for row in sorted(rows, key=lambda r: r["pair"]):
+        suffix = row["suffix"]
+        if suffix not in output_stats:
+            output_stats[suffix] = {
+                "gt_prefix": row["gt_prefix"],
+                "gt_prefix_loss": row["gt_prefix_loss"],
+                "gt_suffix_loss": row["gt_suffix_loss"],
+                "prompt_opts": {}
+            }
+        output_stats[suffix]["prompt_opts"][row["optimizer"]] = {
+            "prefix": row["prefix"],
+            "prefix_loss": row["prefix_loss"],
+            "suffix_loss": row["suffix_loss"],
+            "time": row["time"]
+        }
+    return output_stats
+
+
+def to_instrumentation(rows):
+    # {suffix: {optimizer: stats}} of the instrumented rows, the layout of the old <run>.instrumentation.json
+    instrumentation = {}
+    for row in sorted(rows, key=lambda r: r["pair"]):
+        if row["instrumentation"] is not None:
+            instrumentation.setdefault(row["suffix"], {})[row["optimizer"]] = json.loads(row["instrumentation"])
+    return instrumentation
+
+
+def load_legacy_results(path, run=None):
+    # Rows from a data/reversal_results_*.pkl file, pairs are numbered in the order they were stored
+    if run is None:
+        run = os.path.splitext(os.path.basename(path))[0]
+    with open(path, 'rb') as f:
+        output_stats = pickle.load(f)
+    parameters = output_stats.get("parameters")
+    rows = []
+    if any(key.endswith("_prefixes") for key in output_stats):
+        # Oldest layout: {"<opt>_losses": [...], "<opt>_naturals": [...], "<opt>_prefixes": [(i, prefix), ...]}
+        for key in output_stats:
+            if not key.endswith("_prefixes"):
+                continue
+            opt_name = key[:-len("_prefixes")]
+            losses = output_stats.get(f"{opt_name}_losses", [])
+            naturals = output_stats.get(f"{opt_name}_naturals", [])
+            for i, (p, prefix) in enumerate(output_stats[key]):
+                rows.append(to_row({
+                    "pair": p,
+                    "optimizer": opt_name,
+                    "prefix": prefix,
+                    "prefix_loss": naturals[i] if i < len(naturals) else None,
+                    "suffix_loss": losses[i] if i < len(losses) else None,
+                }, run, parameters))
+        return rows
+    for p, (suffix, stats) in enumerate((k, v) for k, v in output_stats.items() if k != "parameters"):
+        for opt_name, opt_stats in stats["prompt_opts"].items():
+            result = {
+                "pair": p,
+                "optimizer": opt_name,
+                "suffix": suffix,
+                "gt_prefix": stats["gt_prefix"],
+                "gt_prefix_loss": stats["gt_prefix_loss"],
+                "gt_suffix_loss": stats["gt_suffix_loss"],
+            }
+            result.update(opt_stats)
+            rows.append(to_row(result, run, parameters))
+    return rows
+
+
+def import_legacy_results(store, paths):
+    # Copy pickled results into the store, one part file per pickle
+    for path in paths:
+        store.append(load_legacy_results(path))
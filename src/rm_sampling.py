@@ -6,6 +6,9 @@ from datasets import load_dataset
 from typing import Callable, Iterable, Any
 import matplotlib.pyplot as plt
 from src.utils import *
+from src.instrumentation import count_forward, phase
+from src.runtime import get_runtime, inference_context
+from src.token_counts import count_positions, count_tokens, iter_batches, tokenize_prefixes
 
 SOFTMAX_FINAL = nn.Softmax(dim=-1)
 LOGSOFTMAX_FINAL = nn.LogSoftmax(dim=-1)
@@ -33,18 +36,29 @@ class ReverseModelSampler:
         target_string,
         temperature=0.5,
     ):
-        # Just return the best beam search seq
-        initial_targets = reverse_tokenize(self.tokenizer, target_string)
-        initial_inputs = self.tokenizer.encode(initial_input, return_tensors="pt").cuda()
+        initial_inputs = self.tokenizer.encode(initial_input, return_tensors="pt")[0]
+        initial_targets = self.tokenizer.encode(target_string, return_tensors="pt")[0]
+        prefix_ids, _, _ = self.optimize_tokens(initial_inputs, initial_targets, temperature)
+        return self.tokenizer.decode(torch.cat((prefix_ids, initial_targets.to(prefix_ids.device))))
+
+    def optimize_tokens(
+        self,
+        prefix_ids,
+        target_ids,
+        temperature=0.5,
+    ):
+        # Just return the best beam search seq, with the losses it was picked by
+        initial_targets = torch.flip(target_ids, (0,)).unsqueeze(0).to(self.reverse_model.device)
         
         # Sample from the reverse model
-        output = self.reverse_model.generate(
-            initial_targets,
-            max_new_tokens=initial_inputs.shape[-1],
-            temperature=temperature,
-            do_sample=True,
-            num_return_sequences=self.num_beams
-        )
+        with phase("reverse_model_generate"):
+            output = self.reverse_model.generate(
+                initial_targets,
+                max_new_tokens=prefix_ids.shape[-1],
+                temperature=temperature,
+                do_sample=True,
+                num_return_sequences=self.num_beams
+            )
         
         # Choose best output
         pairs_batch = torch.flip(output, (1,))
@@ -52,13 +66,16 @@ class ReverseModelSampler:
             self.model,
             pairs_batch,
             self.tokenizer,
-            prefix_len=initial_inputs.shape[1]
+            prefix_len=prefix_ids.shape[-1]
         )        
-        return reverse_decode(self.tokenizer, output)[torch.argmin(predicted_suffix_loss_batch)]
+        best = torch.argmin(predicted_suffix_loss_batch)
+        return pairs_batch[best, :prefix_ids.shape[-1]], predicted_prefix_loss_batch[best], predicted_suffix_loss_batch[best]
 
 
-def reverse_tokenize(tokenizer, target):
-    input_ids = tokenizer.encode(target, return_tensors="pt").cuda()
+def reverse_tokenize(tokenizer, target, device=None):
+    if device is None:
+        device = get_runtime().device
+    input_ids = tokenizer.encode(target, return_tensors="pt").to(device)
     input_ids = torch.flip(input_ids, (1,))
     return input_ids
 
@@ -81,13 +98,20 @@ class ReverseModelSamplerBeamSearch:
         model: AutoModelForCausalLM,
         reverse_model: AutoModelForCausalLM,
         tokenizer: AutoTokenizer,
-        num_beams=50
+        num_beams=50,
+        screening_model: AutoModelForCausalLM = None,
+        screening_fraction=0.1,
     ):
 
         self.model = model
         self.reverse_model = reverse_model
         self.tokenizer = tokenizer
         self.num_beams = num_beams
+        # Cheaper model rescoring every beam first, only the top screening_fraction is rescored by model
+        self.screening_model = screening_model
+        self.screening_fraction = screening_fraction
+        # Screening mass of p(suffix | beam) over the beams discarded by the last optimize call
+        self.discarded_mass = []
 
     def optimize(
         self,
@@ -95,32 +119,55 @@ class ReverseModelSamplerBeamSearch:
         target_string,
     ):
         # Tokenize prefix and suffix
-        prefix_tokens = self.tokenizer.encode(initial_input)
-        suffix_tokens = self.tokenizer.encode(target_string)
+        prefix_tokens = self.tokenizer.encode(initial_input, return_tensors="pt")[0]
+        suffix_tokens = self.tokenizer.encode(target_string, return_tensors="pt")[0]
+        best_prefix, _, _ = self.optimize_tokens(prefix_tokens, suffix_tokens)
+        return self.tokenizer.decode(torch.cat((best_prefix, suffix_tokens)))
+
+    def optimize_tokens(
+        self,
+        prefix_ids,
+        target_ids,
+    ):
         # Beam search
-        prefix_list = reverse_normalized_beam_generate(
+        target_ids = target_ids.cpu()
+        prefix_batch = reverse_normalized_beam_generate(
             self.reverse_model,
             self.tokenizer,
-            target_string,
-            len(prefix_tokens),
+            target_ids,
+            prefix_ids.shape[-1],
             beam_size=self.num_beams
         )
-        pairs_batch = torch.stack(prefix_list)
-        pairs_batch = torch.cat((pairs_batch, torch.tensor([suffix_tokens]*len(prefix_list))), dim=1)
+        pairs_batch = torch.cat((prefix_batch, target_ids.repeat(len(prefix_batch), 1)), dim=1)
+        self.discarded_mass = []
+        if self.screening_model is not None:
+            _, screening_losses = forward_loss_batch(
+                self.screening_model,
+                pairs_batch,
+                self.tokenizer,
+                prefix_len=prefix_ids.shape[-1],
+                phase_name="screening"
+            )
+            # Mean suffix losses back to log p(suffix | beam)
+            top, mass = screen_candidates(-screening_losses.cpu() * target_ids.shape[-1], self.screening_fraction)
+            record_discarded_mass(mass, self.discarded_mass)
+            prefix_batch, pairs_batch = prefix_batch[top], pairs_batch[top]
         # Call the batched loss function
         predicted_prefix_loss_batch, predicted_suffix_loss_batch = forward_loss_batch(
             self.model,
             pairs_batch,
             self.tokenizer,
-            prefix_len=len(prefix_tokens)
+            prefix_len=prefix_ids.shape[-1]
         )        
-        best_prefix = prefix_list[torch.argmin(predicted_suffix_loss_batch)]
-        return self.tokenizer.decode(best_prefix.tolist() + suffix_tokens)
+        best = torch.argmin(predicted_suffix_loss_batch)
+        return prefix_batch[best], predicted_prefix_loss_batch[best], predicted_suffix_loss_batch[best]
 
 
 def reverse_normalized_forward(reverse_model, tokenizer, target, normalizer=None):
-    inputs = reverse_tokenize(tokenizer, target)
-    outputs = reverse_model(inputs).logits[0,-1,:]
+    inputs = reverse_tokenize(tokenizer, target, reverse_model.device)
+    with inference_context():
+        count_forward(inputs)
+        outputs = reverse_model(inputs).logits[0,-1,:].float()
     outputs = SOFTMAX_FINAL(outputs).cpu()
     if not normalizer is None:
         outputs = torch.mul(outputs, normalizer)
@@ -159,7 +206,7 @@ def reverse_positional_generate(reverse_model, tokenizer, target, max_length, no
     return ''.join(prefix[::-1])+target
 
 
-def get_pos_token_probabilities(tokenizer, dataset="NeelNanda/pile-10k", vocab_size=50304, split='train', prefix=10, prev_counts=None):
+def get_pos_token_probabilities(tokenizer, dataset="NeelNanda/pile-10k", vocab_size=50304, split='train', prefix=10, prev_counts=None, batch_size=1000):
     if type(dataset) == str:
         data = load_dataset(dataset)
     else:
@@ -168,40 +215,28 @@ def get_pos_token_probabilities(tokenizer, dataset="NeelNanda/pile-10k", vocab_s
         counts = torch.zeros((vocab_size, prefix), dtype=torch.float)
     else: 
         counts = prev_counts
-    
-    token_to_string_rough_bound = 10*prefix
-    for chunk in data[split]:
-        text = chunk['text']
-        tokens = tokenizer(text[:token_to_string_rough_bound], return_tensors="pt").input_ids[0]
-        tokens = tokens[:prefix]
-        if len(tokens) < prefix:
-            tokens = tokenizer(text, return_tensors="pt").input_ids[0][:prefix]
-        for t,token in enumerate(tokens):
-            counts[token,t] += 1
+
+    # Texts shorter than prefix tokens still count their first positions
+    for batch in iter_batches((chunk['text'] for chunk in data[split]), batch_size):
+        input_ids = tokenize_prefixes(tokenizer, batch, prefix, skip_short=False)
+        counts += count_positions(input_ids, vocab_size, prefix).to(counts.dtype)
     return counts
 
 
-def get_pos_token_probabilities_pandas(tokenizer, dataset, vocab_size=50304, prefix=10, prev_counts=None):
+def get_pos_token_probabilities_pandas(tokenizer, dataset, vocab_size=50304, prefix=10, prev_counts=None, batch_size=1000):
     if prev_counts is None:
         counts = torch.zeros((vocab_size, prefix), dtype=torch.float)
     else: 
         counts = prev_counts
-    
-    token_to_string_rough_bound = 10*prefix
-    for chunk in dataset:
-        text = chunk[1] #1 is assumed to be first data column having text
-        tokens = tokenizer(text[:token_to_string_rough_bound], return_tensors="pt").input_ids[0]
-        tokens = tokens[:prefix]
-        if len(tokens) < prefix:
-            tokens = tokenizer(text, return_tensors="pt").input_ids[0][:prefix]
-            if len(tokens) < prefix:
-                continue
-        for t,token in enumerate(tokens):
-            counts[token,t] += 1
+
+    # 1 is assumed to be first data column having text, texts shorter than prefix tokens are skipped
+    for batch in iter_batches((chunk[1] for chunk in dataset), batch_size):
+        input_ids = tokenize_prefixes(tokenizer, batch, prefix, skip_short=True)
+        counts += count_positions(input_ids, vocab_size, prefix).to(counts.dtype)
     return counts
 
 
-def get_token_probabilities_pandas(tokenizer, dataset="NeelNanda/pile-10k", vocab_size=50304, split='train', prev_counts=None):
+def get_token_probabilities_pandas(tokenizer, dataset="NeelNanda/pile-10k", vocab_size=50304, split='train', prev_counts=None, batch_size=1000):
     # if type(dataset)==str:
     #     data = load_dataset(dataset)
     # else:
@@ -210,11 +245,8 @@ def get_token_probabilities_pandas(tokenizer, dataset="NeelNanda/pile-10k", voca
         counts = torch.zeros(vocab_size, dtype=torch.float) #tokenizer.vocab_size is fake 50304 is the model output dimension which is what we care about
     else:
         counts = prev_counts
-    for chunk in data:
-        text = chunk[1]
-        tokens = tokenizer(text, return_tensors="pt").input_ids[0]
-        token_counts = torch.bincount(tokens.type(torch.long), minlength=counts.size(0))
-        counts += token_counts
+    for batch in iter_batches((chunk[1] for chunk in data), batch_size):
+        counts += count_tokens(tokenizer(batch).input_ids, counts.size(0)).to(counts.dtype)
 
     # total_tokens = torch.sum(counts)
     # probabilities = counts / total_tokens
@@ -223,68 +255,85 @@ def get_token_probabilities_pandas(tokenizer, dataset="NeelNanda/pile-10k", voca
     return counts
 
 
-def reverse_tokenize_batch(tokenizer, targets):
-    input_ids = tokenizer(targets, return_tensors="pt", padding=True, truncation=True).input_ids.cuda()
+def reverse_tokenize_batch(tokenizer, targets, device=None):
+    if device is None:
+        device = get_runtime().device
+    input_ids = tokenizer(targets, return_tensors="pt", padding=True, truncation=True).input_ids.to(device)
     input_ids = torch.flip(input_ids, (1,))
     return input_ids
 
 
 def reverse_positional_forward(reverse_model, tokenizer, targets, pos, normalizer=None):
     if type(targets) == list:
-        inputs = reverse_tokenize_batch(tokenizer, targets)  # Assume this function can handle batched targets
+        inputs = reverse_tokenize_batch(tokenizer, targets, reverse_model.device)  # Assume this function can handle batched targets
     else:
-        inputs = torch.flip(targets, (1,)).cuda()
-    with torch.no_grad():
-        outputs = reverse_model(inputs).logits[:, -1, :]  # Adjust indexing for batched outputs
+        inputs = torch.flip(targets, (1,)).to(reverse_model.device)
+    with inference_context():
+        count_forward(inputs)
+        outputs = reverse_model(inputs).logits[:, -1, :].float()  # Adjust indexing for batched outputs
     outputs = SOFTMAX_FINAL(outputs).cpu()
     if normalizer is not None:
         outputs = torch.mul(outputs, normalizer[:, pos])
     return outputs
 
 
+def reverse_cached_forward(reverse_model, input_ids, past_key_values=None, pos=None, normalizer=None):
+    # input_ids are already flipped and only hold the tokens that are not in past_key_values yet
+    with phase("reverse_beam_search"), inference_context():
+        count_forward(input_ids)
+        outputs = reverse_model(input_ids, past_key_values=past_key_values, use_cache=True)
+    logprobs = LOGSOFTMAX_FINAL(outputs.logits[:, -1, :].float())
+    if normalizer is not None:
+        logprobs = logprobs + torch.log(normalizer[:, pos].to(logprobs.device))
+    return logprobs, outputs.past_key_values
+
+
 def reverse_normalized_beam_generate(reverse_model, tokenizer, target, max_length, beam_size=10, normalizer=None):
-    beams = [(1, torch.empty(0,))]  # List of tuples of score and prefix
-    target_tokens = tokenizer(target, return_tensors="pt",).input_ids[0]
+    # target is a string or its token ids
+    target_tokens = tokenizer(target, return_tensors="pt",).input_ids[0] if isinstance(target, str) else target
+    # The reverse model reads prefix + target flipped, so each new prefix token is appended to the end of its
+    # input: encode the target once and afterwards only feed the newest token of every beam on top of the cache
+    inputs = torch.flip(target_tokens, (0,)).unsqueeze(0).to(reverse_model.device)
+    past_key_values = None
+    # Beam state is a [beam, len] tensor of prefix tokens and a [beam] tensor of log-scores
+    beam_tokens = torch.empty((1, 0), dtype=target_tokens.dtype, device=inputs.device)
+    beam_scores = torch.zeros(1, device=inputs.device)
     for i in range(max_length):
-        targets = torch.stack([torch.cat((prefix,target_tokens)) for _, prefix in beams]).type(target_tokens.dtype).cuda()
-        normalized_probs = reverse_positional_forward(reverse_model, tokenizer, targets, max_length-i-1, normalizer)
-        candidates = []
-        for j, (score, prefix) in enumerate(beams):
-            probs, indices = torch.topk(normalized_probs[j], beam_size)  # Get top-k probabilities and indices for each beam
-            for prob, idx in zip(probs, indices):  # No batch dimension here, handled in the outer loop
-                new_prefix = torch.cat((idx.view(1,),prefix))
-                new_score = score*prob.item()
-                candidates.append((new_score, new_prefix))
-        # Sort candidates by score and keep the top-k
-        candidates.sort(key=lambda x: x[0], reverse=True)
-        beams = candidates[:beam_size]
-    return [b[1].type(target_tokens.dtype) for b in beams]
+        logprobs, past_key_values = reverse_cached_forward(reverse_model, inputs, past_key_values, max_length-i-1, normalizer)
+        # Expand every beam by every token and keep the top-k of the flattened beam x vocab scores
+        vocab_size = logprobs.shape[-1]
+        beam_scores, flat_idx = torch.topk((beam_scores.unsqueeze(1) + logprobs).view(-1), beam_size)
+        beam_idx = flat_idx // vocab_size
+        new_tokens = flat_idx % vocab_size
+        beam_tokens = torch.cat((new_tokens.unsqueeze(1), beam_tokens[beam_idx]), dim=1)
+        # Keep the cache rows of the parent beams and step forward with the token each beam just prepended
+        past_key_values = reorder_past_key_values(past_key_values, beam_idx)
+        inputs = new_tokens.unsqueeze(1)
+    return beam_tokens.cpu()
 
 
 def reverse_fwd_beam_generate(reverse_model, forward_model, tokenizer, target, max_length, beam_size=10, normalizer=None):
-    beams = [(1, torch.empty(0, dtype=torch.long))]  # List of tuples of score and prefix
-    target_tokens = tokenizer(target, return_tensors="pt").input_ids[0]  
+    target_tokens = tokenizer(target, return_tensors="pt").input_ids[0] if isinstance(target, str) else target
+    inputs = torch.flip(target_tokens, (0,)).unsqueeze(0).to(reverse_model.device)
+    past_key_values = None
+    beam_tokens = torch.empty((1, 0), dtype=target_tokens.dtype, device=inputs.device)
+    target_tokens = target_tokens.to(inputs.device)
     for i in range(max_length):
-        targets = torch.stack([torch.cat((prefix, target_tokens)) for _, prefix in beams]).type(target_tokens.dtype)
-        normalized_probs = reverse_positional_forward(reverse_model, tokenizer, targets, max_length-i-1, normalizer).cpu()
-        candidates = []
-        for j, (_, prefix) in enumerate(beams):
-            _, indices = torch.topk(normalized_probs[j], beam_size)  # Get top-k probabilities and indices for each beam
-            for idx in indices:
-                new_prefix = torch.cat((idx.view(1,), prefix))
-                candidates.append(new_prefix)
-        
-        pairs_batch = torch.stack(candidates)
-        pairs_batch = torch.cat((pairs_batch, target_tokens.repeat(pairs_batch.shape[0],1)), dim=1)
+        logprobs, past_key_values = reverse_cached_forward(reverse_model, inputs, past_key_values, max_length-i-1, normalizer)
+        # Every beam proposes its top-k next tokens under the reverse model
+        indices = torch.topk(logprobs, beam_size, dim=-1).indices
+        candidates = torch.cat((indices.view(-1, 1), beam_tokens.repeat_interleave(beam_size, dim=0)), dim=1)
+        pairs_batch = torch.cat((candidates, target_tokens.repeat(candidates.shape[0], 1)), dim=1)
         
         _, l_suff = forward_loss_batch(forward_model, pairs_batch, tokenizer, prefix_len=i+1)  # Assuming all prefixes have the same length
         
-        # Update candidates with new scores based on forward model loss
-        candidates = [(l_suff[i].item(), candidates[i]) for i in range(len(candidates))]
-        candidates.sort(key=lambda x: x[0], reverse=True)
-        beams = candidates[:beam_size]
+        # Keep the candidates under which the forward model finds the target most likely
+        _, cand_idx = torch.topk(-l_suff.to(candidates.device), beam_size)
+        beam_tokens = candidates[cand_idx]
+        past_key_values = reorder_past_key_values(past_key_values, cand_idx // beam_size)
+        inputs = beam_tokens[:, :1]
     
-    return [b[1].type(target_tokens.dtype) for b in beams]  # Returning tensors as in reverse_normalized_beam_generate
+    return beam_tokens.cpu()  # Same [beam, len] layout as reverse_normalized_beam_generate
 
 def plot_beams(all_losses, all_naturals, beam_size, normalizer_temp, base_prefix_loss=None, base_suffix_loss=None):
     eval_size = len(all_losses)
@@ -0,0 +1,83 @@
+import torch
+
+
+DTYPES = {
+    "fp32": torch.float32,
+    "float32": torch.float32,
+    "bf16": torch.bfloat16,
+    "bfloat16": torch.bfloat16,
+    "fp16": torch.float16,
+    "float16": torch.float16,
+}
+
+
+class InferenceRuntime:
+    """
+    Owns how models are run by the samplers and scorers: the device and dtype models are
+    placed in, the no-autograd context used around model calls, optional torch.compile, the
+    number of CPU threads and the memory batch sizes may plan for.
+    """
+
+    def __init__(
+        self,
+        device: str = None,
+        dtype: str = None,
+        compile: bool = False,
+        num_threads: int = None,
+        num_interop_threads: int = None,
+        inference_mode: bool = True,
+        num_processes: int = 1,
+        memory_budget: int = None,
+        memory_fraction: float = 0.8,
+    ):
+
+        if device is None:
+            device = "cuda" if torch.cuda.is_available() else "cpu"
+        self.device = torch.device(device)
+        self.dtype = DTYPES.get(dtype, dtype)
+        self.compile = compile
+        self.inference_mode = inference_mode
+        # Batch sizes are planned against memory_budget bytes, or a memory_fraction share of the memory
+        # available when planning, split between the num_processes workers sharing the machine
+        self.num_processes = num_processes
+        self.memory_budget = memory_budget
+        self.memory_fraction = memory_fraction
+        if num_threads is not None:
+            torch.set_num_threads(num_threads)
+        if num_interop_threads is not None:
+            # Can only be set once per process, before any inter-op parallel work ran
+            try:
+                torch.set_num_interop_threads(num_interop_threads)
+            except RuntimeError:
+                pass
+
+    def prepare(self, model):
+        # Weights never need gradients here, GCG only differentiates w.r.t. input embeddings
+        model = model.to(device=self.device, dtype=self.dtype)
+        model.eval()
+        model.requires_grad_(False)
+        if self.compile:
+            # The scorers call model.base_model directly, and model.forward goes through it as well
+            model.base_model.compile(dynamic=True)
+        return model
+
+    def inference(self):
+        return torch.inference_mode() if self.inference_mode else torch.no_grad()
+
+
+RUNTIME = InferenceRuntime()
+
+
+def get_runtime():
+    return RUNTIME
+
+
+def set_runtime(runtime):
+    global RUNTIME
+    RUNTIME = runtime
+    return runtime
+
+
+def inference_context():
+    # Context every model call made for sampling or scoring runs in
+    return RUNTIME.inference()
@@ -0,0 +1,134 @@
+import itertools
+import json
+
+import numpy as np
+import torch
+
+from src.checkpoint import load_checkpoint, save_checkpoint
+
+
+def iter_jsonl_texts(path, text_key="text", skip_lines=0):
+    # Stream the text field of a jsonl file, skipped lines are not parsed
+    with open(path) as f:
+        for line in itertools.islice(f, skip_lines, None):
+            yield json.loads(line)[text_key]
+
+
+def iter_batches(iterable, batch_size):
+    iterator = iter(iterable)
+    while True:
+        batch = list(itertools.islice(iterator, batch_size))
+        if not batch:
+            return
+        yield batch
+
+
+def count_tokens(input_ids, vocab_size=50304):
+    # int64 unigram counts of a list of token id lists
+    total = sum(len(ids) for ids in input_ids)
+    flat = np.fromiter(itertools.chain.from_iterable(input_ids), dtype=np.int64, count=total)
+    return torch.from_numpy(np.bincount(flat, minlength=vocab_size)[:vocab_size])
+
+
+def count_positions(input_ids, vocab_size=50304, positions=10):
+    # int64 [vocab_size, positions] counts of token t at position p, over the first `positions` tokens of every row
+    rows = [ids[:positions] for ids in input_ids]
+    lengths = np.fromiter((len(ids) for ids in rows), dtype=np.int64, count=len(rows))
+    flat = np.fromiter(itertools.chain.from_iterable(rows), dtype=np.int64, count=int(lengths.sum()))
+    starts = np.repeat(np.cumsum(lengths) - lengths, lengths)
+    index = flat * positions + (np.arange(flat.shape[0]) - starts)
+    counts = np.bincount(index, minlength=vocab_size * positions)[:vocab_size * positions]
+    return torch.from_numpy(counts).view(vocab_size, positions)
+
+
+def tokenize_prefixes(tokenizer, texts, positions=10, skip_short=True):
+    # Tokenize only the first 10 * positions characters, falling back to the full text when that is too short
+    input_ids = tokenizer([text[:10 * positions] for text in texts]).input_ids
+    short = [i for i, ids in enumerate(input_ids) if len(ids) < positions]
+    if short:
+        retokenized = tokenizer([texts[i] for i in short]).input_ids
+        for i, ids in zip(short, retokenized):
+            input_ids[i] = ids
+    if skip_short:
+        input_ids = [ids[:positions] for ids in input_ids if len(ids) >= positions]
+    return input_ids
+
+
+def count_texts(tokenizer, texts, vocab_size=50304, positions=None, batch_size=1000):
+    # Unigram counts and, when positions is given, positional counts of the first tokens of every text
+    unigram = torch.zeros(vocab_size, dtype=torch.long)
+    positional = torch.zeros((vocab_size, positions), dtype=torch.long) if positions else None
+    for batch in iter_batches(texts, batch_size):
+        unigram += count_tokens(tokenizer(batch).input_ids, vocab_size)
+        if positions:
+            positional += count_positions(tokenize_prefixes(tokenizer, batch, positions), vocab_size, positions)
+    return unigram, positional
+
+
+def count_shard(
+    tokenizer,
+    path,
+    output_path,
+    vocab_size=50304,
+    positions=None,
+    chunk_size=100_000,
+    batch_size=1000,
+    max_chunks=None,
+    text_key="text",
+):
+    """
+    Counts one jsonl shard chunk by chunk. The partial counts are saved to output_path after
+    every chunk, and a restarted call continues after the last completed chunk.
+    "done" is only set once the whole file has been counted.
+    """
+    state = load_checkpoint(output_path)
+    if state is None:
+        state = {
+            "source": path,
+            "unigram": torch.zeros(vocab_size, dtype=torch.long),
+            "positional": torch.zeros((vocab_size, positions), dtype=torch.long) if positions else None,
+            "lines": 0,
+            "chunks": 0,
+            "done": False,
+        }
+    if state["done"]:
+        return state
+    texts = iter_jsonl_texts(path, text_key, skip_lines=state["lines"])
+    for chunk in iter_batches(texts, chunk_size):
+        if max_chunks is not None and state["chunks"] >= max_chunks:
+            # Not done, a later call with a larger max_chunks continues from here
+            return state
+        unigram, positional = count_texts(tokenizer, chunk, vocab_size, positions, batch_size)
+        state["unigram"] += unigram
+        if positions:
+            state["positional"] += positional
+        state["lines"] += len(chunk)
+        state["chunks"] += 1
+        save_checkpoint(output_path, state)
+    state["done"] = True
+    save_checkpoint(output_path, state)
+    return state
+
+
+def merge_counts(paths):
+    # Sum the counts of several shards
+    merged = None
+    for path in paths:
+        state = torch.load(path, weights_only=False)
+        if merged is None:
+            merged = {"unigram": state["unigram"].clone(), "positional": state["positional"], "lines": state["lines"], "sources": []}
+            if merged["positional"] is not None:
+                merged["positional"] = merged["positional"].clone()
+        else:
+            merged["unigram"] += state["unigram"]
+            if merged["positional"] is not None:
+                merged["positional"] += state["positional"]
+            merged["lines"] += state["lines"]
+        merged["sources"].append(state.get("source", path))
+    return merged
+
+
+def counts_to_probs(counts):
+    # Normalize over the vocabulary, per position for [vocab, positions] counts
+    counts = counts.double()
+    return (counts / counts.sum(dim=0, keepdim=True)).float()
@@ -0,0 +1,69 @@
+import hashlib
+import json
+import os
+
+import torch
+
+from src.checkpoint import temporary_path
+
+
+CACHE_DIR = os.environ.get(
+    "REVERSE_DYNAMICS_CACHE",
+    os.path.join(os.path.expanduser("~"), ".cache", "reverse-dynamics-nlp")
+)
+
+# Whether a decoded token may be used, "ascii" is the filter of get_nonascii_toks
+TOKEN_FILTERS = {
+    "ascii": lambda s: s.isascii() and s.isprintable(),
+    "printable": lambda s: s.isprintable(),
+    "no_whitespace": lambda s: s.isascii() and s.isprintable() and not any(c.isspace() for c in s),
+}
+
+# Masks already loaded in this process, keyed by (tokenizer hash, filter)
+TOKEN_MASKS = {}
+
+
+def tokenizer_hash(tokenizer):
+    # Identifies a vocabulary independently of where the tokenizer was loaded from
+    vocab = sorted(tokenizer.get_vocab().items(), key=lambda item: item[1])
+    special = [tokenizer.bos_token_id, tokenizer.eos_token_id, tokenizer.pad_token_id, tokenizer.unk_token_id]
+    return hashlib.sha256(json.dumps([vocab, special]).encode("utf-8")).hexdigest()
+
+
+def compute_token_mask(tokenizer, token_filter="ascii"):
+    # Same tokens as get_nonascii_toks: 0-2 and tokens beyond vocab_size are kept, special tokens are not
+    keep = TOKEN_FILTERS[token_filter]
+    special = [t for t in [tokenizer.bos_token_id, tokenizer.eos_token_id, tokenizer.pad_token_id, tokenizer.unk_token_id] if t is not None]
+    decoded = tokenizer.batch_decode([[i] for i in range(3, tokenizer.vocab_size)])
+    mask = torch.ones(max([tokenizer.vocab_size] + [t + 1 for t in special]), dtype=torch.bool)
+    mask[3:tokenizer.vocab_size] = torch.tensor([keep(s) for s in decoded], dtype=torch.bool)
+    mask[special] = False
+    if "Baichuan2" in tokenizer.name_or_path:
+        mask[101:1000] = False
+    return mask
+
+
+def get_token_mask(tokenizer, token_filter="ascii", cache_dir=None):
+    """
+    Boolean tensor of the tokens allowed by token_filter, at least vocab_size long. Computed once per
+    vocabulary and filter, then loaded from cache_dir.
+    """
+    if cache_dir is None:
+        cache_dir = CACHE_DIR
+    digest = tokenizer_hash(tokenizer)
+    key = (digest, token_filter)
+    if key in TOKEN_MASKS:
+        return TOKEN_MASKS[key]
+    name = os.path.basename(tokenizer.name_or_path.rstrip("/")) or "tokenizer"
+    path = os.path.join(cache_dir, "token_masks", f"{name}-{token_filter}-{digest[:16]}.pt")
+    if os.path.exists(path):
+        mask = torch.load(path)
+    else:
+        mask = compute_token_mask(tokenizer, token_filter)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # Spawned workers may all compute the mask on a cold cache
+        temporary = temporary_path(path)
+        torch.save(mask, temporary)
+        os.replace(temporary, path)
+    TOKEN_MASKS[key] = mask
+    return mask
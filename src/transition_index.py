@@ -0,0 +1,129 @@
+import json
+import os
+
+import numpy as np
+import torch
+import torch.nn.functional as F
+
+from src.checkpoint import temporary_path
+from src.instrumentation import count_forward, phase
+from src.runtime import inference_context
+from src.token_filters import tokenizer_hash
+
+
+# Indexes already loaded in this process, keyed by path
+TRANSITION_INDEXES = {}
+
+INDEX_FILES = ["topk_ids", "topk_logprobs", "inverted_indptr", "inverted_sources", "inverted_logprobs"]
+
+
+def save_array(path, name, array):
+    temporary = temporary_path(os.path.join(path, name + ".npy"))
+    with open(temporary, "wb") as f:
+        np.save(f, array)
+    os.replace(temporary, os.path.join(path, name + ".npy"))
+
+
+def build_transition_index(model, path, top_k=64, batch_size=1024, tokenizer=None, model_name=None):
+    """
+    log p(next | token) of every token under model, from batched single-token forward passes. Every
+    token keeps its top_k next tokens, and the inverted index lists, for every next token, the tokens
+    it is a top_k continuation of. meta.json is written last, so an interrupted build is not loaded.
+    """
+    os.makedirs(path, exist_ok=True)
+    vocab_size = model.get_output_embeddings().weight.shape[0]
+    device = next(model.parameters()).device
+    topk_ids = np.zeros((vocab_size, top_k), dtype=np.int32)
+    topk_logprobs = np.zeros((vocab_size, top_k), dtype=np.float32)
+    with phase("transition_index"), inference_context():
+        for start in range(0, vocab_size, batch_size):
+            input_ids = torch.arange(start, min(start + batch_size, vocab_size), device=device).unsqueeze(1)
+            count_forward(input_ids)
+            logprobs = F.log_softmax(model(input_ids).logits[:, -1, :].float(), dim=-1)
+            values, indices = logprobs.topk(top_k, dim=-1)
+            topk_ids[start:start + input_ids.shape[0]] = indices.cpu().numpy()
+            topk_logprobs[start:start + input_ids.shape[0]] = values.cpu().numpy()
+
+    # CSR over next tokens, sources sorted by decreasing log-probability within every row
+    next_ids = topk_ids.reshape(-1).astype(np.int64)
+    sources = np.repeat(np.arange(vocab_size, dtype=np.int32), top_k)
+    logprobs = topk_logprobs.reshape(-1)
+    order = np.lexsort((-logprobs, next_ids))
+    indptr = np.zeros(vocab_size + 1, dtype=np.int64)
+    indptr[1:] = np.cumsum(np.bincount(next_ids, minlength=vocab_size))
+
+    save_array(path, "topk_ids", topk_ids)
+    save_array(path, "topk_logprobs", topk_logprobs)
+    save_array(path, "inverted_indptr", indptr)
+    save_array(path, "inverted_sources", sources[order])
+    save_array(path, "inverted_logprobs", logprobs[order])
+    meta = {
+        "model": model_name or getattr(model.config, "_name_or_path", None),
+        "tokenizer_hash": tokenizer_hash(tokenizer) if tokenizer is not None else None,
+        "vocab_size": vocab_size,
+        "top_k": top_k,
+    }
+    temporary = temporary_path(os.path.join(path, "meta.json"))
+    with open(temporary, "w") as f:
+        json.dump(meta, f, indent=2)
+    os.replace(temporary, os.path.join(path, "meta.json"))
+    TRANSITION_INDEXES.pop(os.path.abspath(path), None)
+    return load_transition_index(path, tokenizer)
+
+
+def load_transition_index(path, tokenizer=None):
+    # Raises a ValueError when tokenizer does not match the tokenizer the index was built with
+    key = os.path.abspath(path)
+    if key not in TRANSITION_INDEXES:
+        TRANSITION_INDEXES[key] = TransitionIndex(path)
+    if tokenizer is not None:
+        TRANSITION_INDEXES[key].check_tokenizer(tokenizer)
+    return TRANSITION_INDEXES[key]
+
+
+class TransitionIndex:
+    """
+    Memory-mapped top-k forward transitions. shortlist ranks the candidate first tokens of a suffix
+    by log prior + log p(suffix[0] | candidate). Candidates for which suffix[0] is not a top-k
+    continuation are ranked by their k-th log-probability, an upper bound of the true one.
+    """
+
+    def __init__(self, path):
+        with open(os.path.join(path, "meta.json")) as f:
+            self.meta = json.load(f)
+        self.path = path
+        self.vocab_size = self.meta["vocab_size"]
+        self.top_k = self.meta["top_k"]
+        arrays = {name: np.load(os.path.join(path, name + ".npy"), mmap_mode="r") for name in INDEX_FILES}
+        self.topk_ids = arrays["topk_ids"]
+        self.topk_logprobs = arrays["topk_logprobs"]
+        self.indptr = arrays["inverted_indptr"]
+        self.sources = arrays["inverted_sources"]
+        self.logprobs = arrays["inverted_logprobs"]
+        self.bound = torch.tensor(self.topk_logprobs[:, -1])
+
+    def check_tokenizer(self, tokenizer):
+        if self.meta["tokenizer_hash"] is not None and tokenizer_hash(tokenizer) != self.meta["tokenizer_hash"]:
+            raise ValueError(f"Transition index {self.path} was built for another tokenizer")
+
+    def transitions(self, next_token):
+        # Tokens having next_token among their top-k continuations, with log p(next_token | token)
+        start, end = self.indptr[next_token], self.indptr[next_token + 1]
+        return torch.tensor(self.sources[start:end], dtype=torch.long), torch.tensor(self.logprobs[start:end])
+
+    def scores(self, next_tokens, prior=None):
+        # [N, V] upper bounds of log prior + log p(next_tokens[n] | token), exact where the transition is indexed
+        next_tokens = next_tokens.reshape(-1).tolist()
+        scores = self.bound.unsqueeze(0).repeat(len(next_tokens), 1)
+        for row, next_token in enumerate(next_tokens):
+            sources, logprobs = self.transitions(next_token)
+            scores[row, sources] = logprobs
+        if prior is not None:
+            scores = scores + torch.log(prior.float().cpu()[..., :self.vocab_size])
+        return scores
+
+    def shortlist(self, next_tokens, num_candidates, prior=None):
+        # num_candidates first-token candidates per suffix, [K] for a single next token and [N, K] for a batch
+        scores = self.scores(torch.as_tensor(next_tokens), prior)
+        candidates = scores.topk(min(num_candidates, scores.shape[-1]), dim=-1).indices
+        return candidates[0] if torch.as_tensor(next_tokens).dim() == 0 else candidates
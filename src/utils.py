@@ -1,45 +1,218 @@
+import math
+import os
 import torch
 from typing import Callable, Iterable, Any
-from transformers import (AutoModelForCausalLM, AutoTokenizer,
+from transformers import (AutoModelForCausalLM, AutoTokenizer, DynamicCache,
                           GPTNeoXForCausalLM)
+from src.instrumentation import add_metric, count_forward, phase
+from src.runtime import get_runtime, inference_context
 
 
 def rand_init(seq_length: int, tokenizer):
-    return tokenizer.decode(torch.randint(0, tokenizer.vocab_size, (seq_length,)))
+    return tokenizer.decode(rand_init_tokens(seq_length, tokenizer))
+
+
+def rand_init_tokens(seq_length: int, tokenizer):
+    return torch.randint(0, tokenizer.vocab_size, (seq_length,))
 
 
 def forward_loss(model, pair, tokenizer, loss=torch.nn.CrossEntropyLoss(),):
     prefix, suffix = pair
-    whole_tensor = tokenizer(prefix+suffix, return_tensors='pt').input_ids.cuda()
-    with torch.no_grad():
-        logs = model(whole_tensor).logits
+    whole_tensor = tokenizer(prefix+suffix, return_tensors='pt').input_ids.to(model.device)
+    with phase("forward_loss"), inference_context():
+        count_forward(whole_tensor)
+        logs = model(whole_tensor).logits.float()
     start_ind = len(tokenizer.encode(prefix))
     l_pref = loss(logs[0,:start_ind-1], whole_tensor[0,1:start_ind])
     l_suff = loss(logs[0,start_ind-1:-1], whole_tensor[0,start_ind:])
     return l_pref, l_suff
 
 
-def forward_loss_batch(model, pairs, tokenizer, prefix_len=None, loss=torch.nn.CrossEntropyLoss()):
+def forward_loss_tokens(model, prefix_ids, suffix_ids):
+    # Same losses as forward_loss, for token ids that are already split into prefix and suffix ([L] or [batch, L])
+    prefix_ids, suffix_ids = prefix_ids.to(model.device), suffix_ids.to(model.device)
+    squeeze = prefix_ids.dim() == 1
+    if squeeze:
+        prefix_ids = prefix_ids.unsqueeze(0)
+    if suffix_ids.dim() == 1:
+        suffix_ids = suffix_ids.unsqueeze(0).expand(prefix_ids.shape[0], -1)
+    whole_tensor = torch.cat((prefix_ids, suffix_ids), dim=1)
+    with phase("forward_loss"), inference_context():
+        logprobs = token_logprobs(model, whole_tensor)
+    start_ind = prefix_ids.shape[1]
+    l_pref = -logprobs[:, :start_ind-1].mean(dim=1)
+    l_suff = -logprobs[:, start_ind-1:].mean(dim=1)
+    if squeeze:
+        return l_pref[0], l_suff[0]
+    return l_pref, l_suff
+
+
+def gather_logprobs(model, hidden_states, targets, max_logits_elements=2**26):
+    # Log-probabilities of targets under the output head, as the target logit minus a logsumexp computed
+    # over chunks of positions, so neither full [batch, L, vocab] logits nor their log-softmax are held
+    output_embeddings = model.get_output_embeddings()
+    batch_size, length = targets.shape
+    hidden_states = hidden_states.reshape(batch_size * length, -1)
+    targets = targets.reshape(-1)
+    chunk_size = max(1, max_logits_elements // output_embeddings.weight.shape[0])
+    logprobs = torch.empty(targets.shape, device=targets.device)
+    for start in range(0, targets.shape[0], chunk_size):
+        logits = output_embeddings(hidden_states[start:start + chunk_size]).float()
+        target_logits = torch.gather(logits, 1, targets[start:start + chunk_size].unsqueeze(1)).squeeze(1)
+        logprobs[start:start + chunk_size] = target_logits - torch.logsumexp(logits, dim=-1)
+    return logprobs.view(batch_size, length)
+
+
+def token_logprobs(model, input_ids, attention_mask=None):
+    # log p(input_ids[:, t] | input_ids[:, :t]) for every t >= 1, shape [batch, L-1]
+    count_forward(input_ids[:, :-1])
+    hidden_states = model.base_model(
+        input_ids=input_ids[:, :-1],
+        attention_mask=None if attention_mask is None else attention_mask[:, :-1]
+    ).last_hidden_state
+    return gather_logprobs(model, hidden_states, input_ids[:, 1:])
+
+
+def prefix_boundaries(tokenizer, prefix_batch, suffix_batch):
+    # Tokenize every prefix + suffix once; the prefix ends before the first token starting inside the suffix
+    whole_text_batch = [prefix + suffix for prefix, suffix in zip(prefix_batch, suffix_batch)]
+    if not tokenizer.is_fast:
+        input_ids = tokenizer(whole_text_batch).input_ids
+        return input_ids, [len(tokenizer.encode(prefix)) for prefix in prefix_batch]
+    encoded = tokenizer(whole_text_batch, return_offsets_mapping=True)
+    start_indices = [
+        sum(1 for start, end in offsets if start < len(prefix))
+        for prefix, offsets in zip(prefix_batch, encoded.offset_mapping)
+    ]
+    return encoded.input_ids, start_indices
+
+
+def length_buckets(lengths, max_tokens):
+    # Rows sorted by length and cut into batches of at most max_tokens padded tokens
+    order = sorted(range(len(lengths)), key=lambda i: lengths[i])
+    buckets, bucket = [], []
+    for i in order:
+        if bucket and (len(bucket) + 1) * lengths[i] > max_tokens:
+            buckets.append(bucket)
+            bucket = []
+        bucket.append(i)
+    if bucket:
+        buckets.append(bucket)
+    return buckets
+
+
+def forward_loss_batch(model, pairs, tokenizer, prefix_len=None, loss=None, max_tokens=2**15, phase_name="forward_rescoring"):
+    # Mean negative log-likelihoods of prefix and suffix per row, the loss is always the cross-entropy.
+    # pairs are (prefix, suffix) strings or a [batch, L] tensor whose first prefix_len tokens are the prefix
+    if loss is not None:
+        raise ValueError("forward_loss_batch only computes the cross-entropy, custom losses are not supported")
     if type(pairs) == list:
         prefix_batch, suffix_batch = zip(*pairs)
-        whole_text_batch = [prefix + suffix for prefix, suffix in zip(prefix_batch, suffix_batch)]
-        whole_tensor = tokenizer(whole_text_batch, return_tensors='pt', padding=True, truncation=True).input_ids.cuda()
-    else:
-        whole_tensor = pairs.cuda()
-    with torch.no_grad():
-        logs = model(whole_tensor).logits
-    if prefix_len is None:
-        start_indices = [len(tokenizer.encode(prefix)) for prefix in prefix_batch]
+        input_ids, start_indices = prefix_boundaries(tokenizer, prefix_batch, suffix_batch)
+        lengths = [len(ids) for ids in input_ids]
+        buckets = length_buckets(lengths, max_tokens)
     else:
-        start_indices = [prefix_len] * len(whole_tensor)
-    l_pref_batch = []
-    l_suff_batch = []
-    for (start_ind, whole_tensor_i, logs_i) in zip(start_indices, whole_tensor, logs):
-        l_pref = loss(logs_i[:start_ind-1], whole_tensor_i[1:start_ind]) #start_ind=1 case?
-        l_suff = loss(logs_i[start_ind-1:-1], whole_tensor_i[start_ind:])
-        l_pref_batch.append(l_pref)
-        l_suff_batch.append(l_suff)
-    return torch.stack(l_pref_batch), torch.stack(l_suff_batch)
+        input_ids = pairs.to(model.device)
+        lengths = [input_ids.shape[1]] * input_ids.shape[0]
+        start_indices = [prefix_len] * input_ids.shape[0]
+        buckets = [list(range(start, min(start + max(1, max_tokens // input_ids.shape[1]), input_ids.shape[0])))
+                   for start in range(0, input_ids.shape[0], max(1, max_tokens // input_ids.shape[1]))]
+    pad_token_id = tokenizer.pad_token_id if tokenizer.pad_token_id is not None else 0
+    l_pref_batch = torch.empty(len(lengths), device=model.device)
+    l_suff_batch = torch.empty(len(lengths), device=model.device)
+    for bucket in buckets:
+        max_len = max(lengths[i] for i in bucket)
+        if isinstance(input_ids, torch.Tensor):
+            whole_tensor = input_ids[bucket]
+            attention_mask = None
+        else:
+            # Right padding, so padded positions never precede a real token
+            whole_tensor = torch.full((len(bucket), max_len), pad_token_id, dtype=torch.long)
+            attention_mask = torch.zeros((len(bucket), max_len), dtype=torch.long)
+            for k, i in enumerate(bucket):
+                whole_tensor[k, :lengths[i]] = torch.tensor(input_ids[i])
+                attention_mask[k, :lengths[i]] = 1
+            whole_tensor, attention_mask = whole_tensor.to(model.device), attention_mask.to(model.device)
+        with phase(phase_name), inference_context():
+            logprobs = token_logprobs(model, whole_tensor, attention_mask)
+        # Position t scores token t + 1: prefix tokens 1..start-1, suffix tokens start..length-1
+        positions = torch.arange(max_len - 1, device=model.device).unsqueeze(0)
+        starts = torch.tensor([start_indices[i] for i in bucket], device=model.device).unsqueeze(1)
+        ends = torch.tensor([lengths[i] for i in bucket], device=model.device).unsqueeze(1)
+        pref_mask = positions < starts - 1
+        suff_mask = (positions >= starts - 1) & (positions < ends - 1)
+        rows = torch.tensor(bucket, device=model.device)
+        l_pref_batch[rows] = -(logprobs * pref_mask).sum(dim=1) / pref_mask.sum(dim=1)
+        l_suff_batch[rows] = -(logprobs * suff_mask).sum(dim=1) / suff_mask.sum(dim=1)
+    return l_pref_batch, l_suff_batch
+
+
+def screen_candidates(scores, screening_fraction):
+    # Indices of the top screening_fraction of candidates by screening posterior, and the posterior mass of the rest
+    posterior = torch.log_softmax(scores, dim=-1)
+    keep = max(1, math.ceil(screening_fraction * scores.shape[-1]))
+    top = posterior.topk(min(keep, scores.shape[-1]), dim=-1).indices
+    mass = (1 - posterior.gather(-1, top).exp().sum(dim=-1)).clamp(min=0)
+    return top, mass
+
+
+def record_discarded_mass(mass, discarded_mass=None):
+    # Reported to the instrumentation and appended to the discarded_mass list of the caller
+    for value in mass.reshape(-1).tolist():
+        add_metric("screening_discarded_mass", value)
+        if discarded_mass is not None:
+            discarded_mass.append(value)
+
+
+def reorder_past_key_values(past_key_values, beam_idx):
+    # Gather the cached keys/values of the beams that survived pruning (rows may repeat)
+    if hasattr(past_key_values, "reorder_cache"):
+        past_key_values.reorder_cache(beam_idx)
+        return past_key_values
+    return tuple(
+        tuple(state.index_select(0, beam_idx.to(state.device)) for state in layer)
+        for layer in past_key_values
+    )
+
+
+def select_past_key_values(past_key_values, rows, length):
+    # Copy of the first `length` cached positions of the given batch rows (rows may repeat)
+    if isinstance(past_key_values, tuple):
+        return tuple(tuple(state[rows, :, :length] for state in layer) for layer in past_key_values)
+    return DynamicCache([
+        (layer.keys[rows, :, :length], layer.values[rows, :, :length]) for layer in past_key_values.layers
+    ])
+
+
+def available_memory(device):
+    # Free bytes on a CUDA device, or the memory the OS reports as available for CPU tensors
+    device = torch.device(device)
+    if device.type == "cuda":
+        free, _ = torch.cuda.mem_get_info(device)
+        return free
+    try:
+        with open("/proc/meminfo") as f:
+            for line in f:
+                if line.startswith("MemAvailable:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return os.sysconf("SC_AVPHYS_PAGES") * os.sysconf("SC_PAGE_SIZE")
+
+
+def memory_budget(device):
+    # Bytes this process may plan batches for, see InferenceRuntime. Worker processes share the available
+    # memory, and Linux usually kills a process that overcommits instead of raising an out-of-memory error
+    runtime = get_runtime()
+    if runtime.memory_budget is not None:
+        return runtime.memory_budget
+    return int(available_memory(device) * runtime.memory_fraction / max(runtime.num_processes, 1))
+
+
+def is_out_of_memory(error):
+    # CUDA raises OutOfMemoryError, the CPU allocator a plain RuntimeError
+    message = str(error)
+    return isinstance(error, torch.cuda.OutOfMemoryError) or "out of memory" in message or "can't allocate memory" in message
 
 
 def start_chunk_hf(chunk, tokenizer, num_prefix_tokens=10, num_suffix_tokens=40):